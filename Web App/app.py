@@ -1,147 +1,247 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
-import pandas as pd
+import atexit
+import gzip
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from flask import Flask, render_template, request, redirect, url_for, flash, g, has_request_context
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.linear_model import LinearRegression
+
+# The engine (recommender.py) and the artifact cache are shared with main.py at the repository root; the
+# engine reads its data files from the working directory, this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import recommender
+from recommender import read_state, validate_user
+
+recommender.load_state()
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'
 
-# Load data
-df = pd.read_csv("Food survey.csv")
-df.set_index('UserID', inplace=True)
-dishes = df.copy()
-dish_names = dishes.columns.values
-
-inventory_df = pd.read_csv('temp_dish_inventory.csv')
-ingredient_columns = inventory_df.columns[2:-4].tolist()
-meal_time_columns = inventory_df.columns[-4:].tolist()
+# Instrumentation: the engine counts and times its stages (recommender.stage_seconds and event_counts); this adds
+# request latency per endpoint and serves all of it as Prometheus text on /metrics. Figures are per worker process
+TIMING_HEADERS = False  # add a Server-Timing header listing the stages each request ran
 
-ingredients = inventory_df[ingredient_columns].values
-meal_times = inventory_df[meal_time_columns].values
+request_seconds = {}  # endpoint -> [requests, total seconds]
 
-# Calculate dish similarity
-dish_similarity = cosine_similarity(dishes.T)
 
-# Dictionary to track recently selected dishes for each user
-recently_selected = {}
+def record_stage(stage, seconds):
+    # Collect the stages a request ran for its Server-Timing header
+    if TIMING_HEADERS and has_request_context():
+        g.setdefault('stage_timings', []).append((stage, seconds))
 
-# Linear Regression Model
-x = np.array(df)
-y = np.arange(len(df)).reshape(-1, 1)
-linear_model = LinearRegression().fit(y, x)
 
-users = {user_id: str(user_id) for user_id in df.index}
+recommender.stage_observers.append(record_stage)
 
 
-# Helper Functions
-def validate_user(user_id):
-    return user_id in dishes.index
+# Flashed when a request is answered by a fallback path, again when the answer comes from the cache
+RECOMMENDATION_NOTICES = {
+    'partial': "No dishes fully match your available ingredients. Showing the closest matches...",
+    'retry': "No dishes fully match your available ingredients. Trying with similar dishes...",
+}
 
 
-def check_ingredients(dish_id, available_ingredients):
-    dish_row = inventory_df[inventory_df['Item_id'] == dish_id]
-    if dish_row.empty:
-        return False
+def get_recommendations(user_id, selected_ingredients, meal_time, num_recommendations=5, engine=None):
+    # (dish id, name) pairs for the page, with a flash when a fallback path answered
+    path, recommendations = read_state(lambda: recommender.recommend(user_id, selected_ingredients, meal_time,
+                                                                      num_recommendations, engine))
+    if path in RECOMMENDATION_NOTICES:
+        flash(RECOMMENDATION_NOTICES[path])
+    return [(i, recommender.dish_names[i]) for i, _ in recommendations]
 
-    dish_ingredients = set(
-        ingredient_columns[j]
-        for j in range(len(ingredient_columns))
-        if dish_row[ingredient_columns[j]].values[0] == 1
-    )
-    available_ingredients_set = set(available_ingredients)
-    return dish_ingredients.issubset(available_ingredients_set)
 
+# Feedback from /select_dish is queued and applied by a background worker, so the request never
+# waits on similarity updates or disk. A full queue blocks the producer (backpressure) and is counted.
+FEEDBACK_QUEUE_SIZE = 1024
+FEEDBACK_BATCH_SIZE = 64
+feedback_queue = queue.Queue(maxsize=FEEDBACK_QUEUE_SIZE)
+feedback_stats = {'enqueued': 0, 'applied': 0, 'failed': 0, 'batches': 0, 'batch_errors': 0, 'blocked': 0,
+                  'max_depth': 0}
+feedback_stats_lock = threading.Lock()
+feedback_worker = None
+feedback_worker_lock = threading.Lock()
 
-def select_neighborhood(similarity_matrix, item_id, neighborhood_size):
-    item_similarity_scores = similarity_matrix[item_id]
-    sorted_indices = np.argsort(item_similarity_scores)[::-1]
-    neighborhood = sorted_indices[1:neighborhood_size + 1]  # Exclude the item itself
-    return neighborhood
 
+def enqueue_feedback(user_id, dish_id):
+    global feedback_worker
 
-def retry_cosine_similarity(user_id, recommendations, num_recommendations=5):
-    filtered_recommendations = []
+    with feedback_worker_lock:
+        if feedback_worker is None or not feedback_worker.is_alive():
+            feedback_worker = threading.Thread(target=feedback_loop, name='feedback-worker', daemon=True)
+            feedback_worker.start()
 
-    for i, _ in recommendations:
-        # Check if the ingredients match
-        if check_ingredients(i, recently_selected.get(user_id, [])):
-            filtered_recommendations.append((i, _))
+    blocked = False
+    try:
+        feedback_queue.put_nowait((user_id, dish_id))
+    except queue.Full:
+        blocked = True
+        feedback_queue.put((user_id, dish_id))
+    with feedback_stats_lock:
+        feedback_stats['blocked'] += blocked
+        feedback_stats['enqueued'] += 1
+        feedback_stats['max_depth'] = max(feedback_stats['max_depth'], feedback_queue.qsize())
 
-    # If still no recommendations, fall back to cosine similarity
-    if not filtered_recommendations:
-        dish_indices = [i for i, _ in recommendations]
-        dish_scores = [similarity for _, similarity in recommendations]
 
-        # Sort by highest cosine similarity scores
-        sorted_indices = np.argsort(dish_scores)[::-1]
-        for idx in sorted_indices:
-            if len(filtered_recommendations) < num_recommendations:
-                filtered_recommendations.append((dish_indices[idx], dish_scores[idx]))
-            else:
+def feedback_loop():
+    while True:
+        events = [feedback_queue.get()]
+        while len(events) < FEEDBACK_BATCH_SIZE and events[-1] is not None:
+            try:
+                events.append(feedback_queue.get_nowait())
+            except queue.Empty:
                 break
 
-    return filtered_recommendations
-
-
-def get_recommendations(user_id, selected_ingredients, meal_time):
-    user_ratings = dishes.loc[user_id].values
-    unrated_dishes = [(i, user_ratings[i]) for i in range(len(user_ratings)) if user_ratings[i] < 3]
-    sorted_unrated = sorted(unrated_dishes, key=lambda x: x[1], reverse=True)
-
-    recommendations = [(i, score) for i, score in sorted_unrated if i not in recently_selected.get(user_id, [])]
-
-    # Filter based on ingredients
-    filtered_recommendations = []
-    for i, score in recommendations:
-        if check_ingredients(i, selected_ingredients):
-            filtered_recommendations.append((i, score))
-
-    if not filtered_recommendations:
-        flash("No dishes fully match your available ingredients. Trying with similar dishes...")
-        filtered_recommendations = retry_cosine_similarity(user_id, recommendations)
-
-    return [(i, dish_names[i]) for i, score in filtered_recommendations[:5]]
-
-
-
-def update_data(user_id, selected_dish, neighborhood_size=5):
-    hood = select_neighborhood(dish_similarity, selected_dish, neighborhood_size)
-
-    for i in hood:
-        current_rating = dishes.loc[user_id, dish_names[i]]
-        if dish_similarity[selected_dish][i] < 0.5:
-            adjustment = 0.1
-        else:
-            adjustment = -0.2 if current_rating > 1.2 else 0
-        dish_similarity[selected_dish][i] += adjustment
-
-        dish_name = dish_names[i]
-
-        new_rating = np.clip(dishes.loc[user_id, dish_name] + adjustment, 1, 5)
-        new_rating = round(new_rating, 1)
-        print(f"User {user_id}: Dish '{dish_names[i]}' - Previous Rating: {current_rating}, Updated Rating: {new_rating}")
-        dishes.loc[user_id, dish_name] = new_rating
-
-    #? Track the recently selected dish
-    if user_id not in recently_selected:
-        recently_selected[user_id] = []
-    recently_selected[user_id].append(selected_dish)
-
-    #? Limit the number of tracked recent dishes (e.g., 3)
-    if len(recently_selected[user_id]) > 3:
-        recently_selected[user_id].pop(0)
-
-    #? Save the updated data to CSV
-    df.loc[user_id] = dishes.loc[user_id]
-    df.to_csv("Food survey.csv")
+        stop = events[-1] is None
+        batch = [event for event in events if event is not None]
+        try:
+            apply_feedback_events(batch)
+        except Exception:
+            # Not requeued: the engine may have applied part of the batch in memory, and replaying it
+            # would count those selections twice. Log it, count it and keep the worker running.
+            app.logger.exception("Feedback batch of %d events failed: %s", len(batch), batch)
+            with feedback_stats_lock:
+                feedback_stats['failed'] += len(batch)
+                feedback_stats['batch_errors'] += 1
+        finally:
+            for _ in events:
+                feedback_queue.task_done()
+        if stop:
+            return
+
+
+def apply_feedback_events(events):
+    # One batch through the engine, which applies the events in arrival order with one journal write per user
+    if not events:
+        return
+    failed = recommender.apply_feedback_batch(events)
+    for user_id, dish_id in failed:
+        app.logger.warning("Dropping feedback for user %s, dish %s", user_id, dish_id)
+    with feedback_stats_lock:
+        feedback_stats['applied'] += len(events) - len(failed)
+        feedback_stats['failed'] += len(failed)
+        feedback_stats['batches'] += 1
+
+
+def flush_feedback():
+    # Wait for everything queued so far to be applied and synced. Shutdown needs no call: stop_feedback_worker
+    # queues its stop marker behind the pending events, so the worker applies them all before it exits
+    if feedback_worker is not None and feedback_worker.is_alive():
+        feedback_queue.join()
+
+
+def stop_feedback_worker():
+    if feedback_worker is not None and feedback_worker.is_alive():
+        feedback_queue.put(None)
+        feedback_worker.join()
+
+
+atexit.register(stop_feedback_worker)
+
+
+# Routes that never wait on catch_up: feedback is only queued (the worker applies it under the writer, which catches
+# up first; api_feedback catches up only to recheck ids it does not know) and /metrics reports this worker's counters
+NO_CATCH_UP_ENDPOINTS = {'select_dish', 'api_feedback', 'metrics'}
+
+
+@app.before_request
+def pick_up_changes():
+    if recommender.METRICS_ENABLED:
+        g.request_start = time.perf_counter()
+    if request.endpoint not in NO_CATCH_UP_ENDPOINTS:
+        recommender.catch_up()
+
+
+@app.after_request
+def record_request_time(response):
+    if recommender.METRICS_ENABLED and 'request_start' in g:
+        elapsed = time.perf_counter() - g.request_start
+        with recommender.metrics_lock:
+            totals = request_seconds.setdefault(request.endpoint or 'unknown', [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+        if TIMING_HEADERS:
+            stages = [f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in g.get('stage_timings', [])]
+            response.headers['Server-Timing'] = ", ".join(stages + [f"total;dur={elapsed * 1000:.3f}"])
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text exposition format
+    with recommender.metrics_lock:
+        stages = {stage: list(totals) for stage, totals in recommender.stage_seconds.items()}
+        endpoints = {endpoint: list(totals) for endpoint, totals in request_seconds.items()}
+        events = dict(recommender.event_counts)
+
+    lines = [
+        "# HELP meal_harmony_stage_seconds Time spent in each instrumented stage",
+        "# TYPE meal_harmony_stage_seconds summary",
+    ]
+    for stage, (calls, seconds) in sorted(stages.items()):
+        lines.append(f'meal_harmony_stage_seconds_count{{stage="{stage}"}} {calls}')
+        lines.append(f'meal_harmony_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+
+    lines += [
+        "# HELP meal_harmony_request_seconds Request latency by endpoint",
+        "# TYPE meal_harmony_request_seconds summary",
+    ]
+    for endpoint, (calls, seconds) in sorted(endpoints.items()):
+        lines.append(f'meal_harmony_request_seconds_count{{endpoint="{endpoint}"}} {calls}')
+        lines.append(f'meal_harmony_request_seconds_sum{{endpoint="{endpoint}"}} {seconds:.6f}')
+
+    lines += [
+        "# HELP meal_harmony_recommendations_total Recommendation requests by the path that answered them",
+        "# TYPE meal_harmony_recommendations_total counter",
+    ]
+    for (event, label), value in sorted(events.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        if event == 'recommendations':
+            lines.append(f'meal_harmony_recommendations_total{{path="{label}"}} {value}')
+    lines += [
+        "# HELP meal_harmony_neighbor_updates_total Ratings adjusted by dish selections",
+        "# TYPE meal_harmony_neighbor_updates_total counter",
+        f"meal_harmony_neighbor_updates_total {events.get(('neighbor_updates', None), 0)}",
+    ]
+
+    with feedback_stats_lock:
+        feedback = dict(feedback_stats)
+    lines += [
+        "# HELP meal_harmony_feedback_total Feedback queue events",
+        "# TYPE meal_harmony_feedback_total counter",
+    ]
+    lines += [f'meal_harmony_feedback_total{{event="{event}"}} {value}'
+              for event, value in feedback.items() if event != 'max_depth']
+    lines += [
+        "# HELP meal_harmony_recommendation_cache_total Recommendation cache lookups and removals",
+        "# TYPE meal_harmony_recommendation_cache_total counter",
+    ]
+    lines += [f'meal_harmony_recommendation_cache_total{{event="{event}"}} {value}'
+              for event, value in recommender.recommendation_cache_stats.items()]
+
+    lines += [
+        "# HELP meal_harmony_feedback_queue_depth Feedback events waiting to be applied",
+        "# TYPE meal_harmony_feedback_queue_depth gauge",
+        f"meal_harmony_feedback_queue_depth {feedback_queue.qsize()}",
+        "# HELP meal_harmony_feedback_queue_max_depth Deepest the feedback queue has been",
+        "# TYPE meal_harmony_feedback_queue_max_depth gauge",
+        f"meal_harmony_feedback_queue_max_depth {feedback['max_depth']}",
+        "# HELP meal_harmony_recommendation_cache_entries Entries in the recommendation cache",
+        "# TYPE meal_harmony_recommendation_cache_entries gauge",
+        f"meal_harmony_recommendation_cache_entries {len(recommender.recommendation_cache)}",
+        "# HELP meal_harmony_users Users known to this worker",
+        "# TYPE meal_harmony_users gauge",
+        f"meal_harmony_users {len(recommender.user_index)}",
+    ]
+    return "\n".join(lines) + "\n", 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         user_id = int(request.form['user_id'])
-        if validate_user(user_id):
+        if read_state(lambda: validate_user(user_id)):
             return redirect(url_for('interact', user_id=user_id))
         else:
             flash("User does not exist. Please create a new account.")
@@ -153,17 +253,14 @@ def index():
 def create_account():
     if request.method == 'POST':
         user_id = int(request.form['user_id'])
-        name = request.form['username']
-        new_data = linear_model.predict([[user_id]])
-        new_ratings = np.clip(new_data[0], 1, 5)
-        new_ratings = np.round(new_ratings, 1)
-
-        new_user_data = pd.Series(new_ratings, index=dishes.columns, name=user_id)
-        dishes.loc[user_id] = new_ratings
-        df.loc[user_id] = new_ratings
-        df.to_csv("Food survey.csv", index_label='UserID')
+
+        # The ingredients and meal time picked at sign-up choose the cold-start prior
+        if not recommender.add_user(user_id, request.form['username'], request.form.getlist('ingredients'),
+                                    request.form.get('meal_time') or None):
+            flash("User ID already exists. Please log in or choose another ID.")
+            return redirect(url_for('create_account'))
         return redirect(url_for('interact', user_id=user_id))
-    return render_template('create.html')
+    return render_template('create.html', ingredients=recommender.ingredient_columns)
 
 
 @app.route('/interact/<int:user_id>', methods=['GET', 'POST'])
@@ -172,16 +269,201 @@ def interact(user_id):
         meal_time = request.form['meal_time']
         selected_ingredients = request.form.getlist('ingredients')
         recommendations = get_recommendations(user_id, selected_ingredients, meal_time)
-        return render_template('recommendations.html', user_id=user_id, recommendations=recommendations)
-    return render_template('interact.html', user_id=user_id, ingredients=ingredient_columns)
+        pantry = recommender.build_pantry_mask(selected_ingredients)
+        matches = {dish_id: recommender.describe_match(dish_id, pantry) for dish_id, _ in recommendations}
+        return render_template('recommendations.html', user_id=user_id, recommendations=recommendations, matches=matches)
+    return render_template('interact.html', user_id=user_id, ingredients=recommender.ingredient_columns)
 
 
 @app.route('/select_dish/<int:user_id>/<int:dish_id>')
 def select_dish(user_id, dish_id):
-    update_data(user_id, dish_id)
-    flash(f"You have selected {dish_names[dish_id]}")
+    flash(f"You have selected {recommender.dish_names[dish_id]}")
+    enqueue_feedback(user_id, dish_id)
     return redirect(url_for('interact', user_id=user_id))
 
 
+# JSON API for the Android client. Responses are compact JSON (dish ids and scores, names only in the
+# dish list), gzipped when the client accepts it and the body is big enough to gain from it. The dish and
+# ingredient lists carry an ETag, so a client holding the current version gets an empty 304. Reads go
+# through read_state against this worker's preloaded model, like the HTML pages
+API_GZIP_MIN_BYTES = 512
+API_MAX_BATCH = 1024
+API_SCORE_DIGITS = 4
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_response(payload, status=200, etag=False):
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    response = app.response_class(body, status=status, mimetype='application/json')
+    if etag:
+        # Weak: the gzipped and plain bodies are the same data
+        response.add_etag(weak=True)
+        response.make_conditional(request)
+    if response.status_code == 200 and len(body) >= API_GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.errorhandler(ApiError)
+def api_error(error):
+    return api_response({'error': str(error)}, error.status)
+
+
+def api_json():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        raise ApiError("expected a JSON object")
+    return payload
+
+
+def api_int(value, field):
+    if isinstance(value, bool):
+        raise ApiError(f"{field} must be an integer")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(f"{field} must be an integer")
+
+
+def api_names(value, field):
+    # A list of names, or one comma-separated string
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [name for name in value.split(',') if name]
+    if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+        raise ApiError(f"{field} must be a list of names")
+    return value
+
+
+def api_items(payload, key):
+    # A batch under key, or the payload itself as a batch of one
+    items = payload[key] if key in payload else [payload]
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ApiError(f"{key} must be a list of objects")
+    if len(items) > API_MAX_BATCH:
+        raise ApiError(f"at most {API_MAX_BATCH} {key} per request", 413)
+    return items
+
+
+@app.route('/api/v1/dishes')
+def api_dishes():
+    # Dish names by id, with the meal times each is served at
+    return api_response({
+        'dishes': list(recommender.dish_names),
+        'meal_times': {meal_time: np.flatnonzero(mask[:len(recommender.dish_names)]).tolist()
+                       for meal_time, mask in recommender.meal_time_masks.items()},
+    }, etag=True)
+
+
+@app.route('/api/v1/ingredients')
+def api_ingredients():
+    return api_response({'ingredients': list(recommender.ingredient_columns)}, etag=True)
+
+
+@app.route('/api/v1/users', methods=['POST'])
+def api_create_user():
+    payload = api_json()
+    user_id = api_int(payload.get('user_id'), 'user_id')
+    meal_time = api_names(payload.get('meal_time'), 'meal_time') or None
+    ingredients = api_names(payload.get('ingredients'), 'ingredients') or None
+    if not recommender.add_user(user_id, str(payload.get('name', user_id)), ingredients, meal_time):
+        raise ApiError("user already exists", 409)
+    return api_response({'user_id': user_id}, 201)
+
+
+@app.route('/api/v1/users/<int:user_id>')
+def api_user(user_id):
+    if not read_state(lambda: validate_user(user_id)):
+        raise ApiError("unknown user", 404)
+    return api_response({'user_id': user_id, 'name': recommender.users.get(user_id),
+                         'recent': read_state(lambda: recommender.recent_selections(user_id))})
+
+
+@app.route('/api/v1/recommendations', methods=['GET', 'POST'])
+def api_recommendations():
+    # GET ?user_id=&ingredients=a,b&meal_time=&n= for one user, through recommend and its cache; POST {"n": 5,
+    # "requests": [{"user_id", "ingredients", "meal_time"}, ...]} for many, answered in one get_recommendations_batch call
+    if request.method == 'GET':
+        n = api_int(request.args.get('n', 5), 'n')
+        ingredients = [name for value in request.args.getlist('ingredients') for name in api_names(value, 'ingredients')]
+        items = [{'user_id': request.args.get('user_id'), 'ingredients': ingredients, 'meal_time': request.args.getlist('meal_time')}]
+    else:
+        payload = api_json()
+        n = api_int(payload.get('n', 5), 'n')
+        items = api_items(payload, 'requests')
+    num_dishes = len(recommender.dish_names)
+    if not 0 < n <= num_dishes:
+        raise ApiError(f"n must be between 1 and {num_dishes}")
+
+    user_ids = [api_int(item.get('user_id'), 'user_id') for item in items]
+    meal_times = [api_names(item.get('meal_time'), 'meal_time') or None for item in items]
+
+    if request.method == 'GET':
+        def recommend_one():
+            if not validate_user(user_ids[0]):
+                return None
+            return recommender.recommend(user_ids[0], items[0]['ingredients'], meal_times[0], n)[1]
+
+        recommendations = read_state(recommend_one)
+        if recommendations is None:
+            raise ApiError("unknown user", 404)
+        return api_response({
+            'user_id': user_ids[0],
+            'dish_ids': [int(i) for i, _ in recommendations],
+            'scores': np.round([float(score) for _, score in recommendations], API_SCORE_DIGITS).tolist(),
+        })
+
+    pantries = np.array([recommender.build_pantry_mask(api_names(item.get('ingredients'), 'ingredients')) for item in items])
+
+    def recommend():
+        rows = [row for row, user_id in enumerate(user_ids) if validate_user(user_id)]
+        if not rows:
+            return rows, [], []
+        dish_ids, scores = recommender.get_recommendations_batch([user_ids[row] for row in rows], pantries[rows],
+                                                                 [meal_times[row] for row in rows], n)
+        return rows, dish_ids, scores
+
+    rows, dish_ids, scores = read_state(recommend)
+    results = [{'user_id': user_id, 'error': "unknown user"} for user_id in user_ids]
+    for row, ids, row_scores in zip(rows, dish_ids, scores):
+        valid = ids >= 0
+        results[row] = {
+            'user_id': user_ids[row],
+            'dish_ids': ids[valid].tolist(),
+            'scores': np.round(row_scores[valid], API_SCORE_DIGITS).tolist(),
+        }
+    return api_response({'recommendations': results})
+
+
+@app.route('/api/v1/feedback', methods=['POST'])
+def api_feedback():
+    # {"user_id", "dish_id"} or {"events": [...]}; queued like /select_dish, so 202 before it is applied
+    events = [(api_int(item.get('user_id'), 'user_id'), api_int(item.get('dish_id'), 'dish_id'))
+              for item in api_items(api_json(), 'events')]
+
+    def check():
+        return [(user_id, dish_id) for user_id, dish_id in events
+                if not validate_user(user_id) or not 0 <= dish_id < len(recommender.dish_names)]
+
+    invalid = read_state(check)
+    if invalid:
+        # Maybe created by another process since this one last caught up
+        recommender.catch_up()
+        invalid = read_state(check)
+    if invalid:
+        raise ApiError(f"unknown user or dish: {invalid[:10]}")
+    for user_id, dish_id in events:
+        enqueue_feedback(user_id, dish_id)
+    return api_response({'accepted': len(events)}, 202)
+
+
 if __name__ == "__main__":
     app.run(debug=True)
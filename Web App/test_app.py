@@ -0,0 +1,209 @@
+import gzip
+import importlib
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+# Checks of the JSON API through Flask's test client. The app loads the engine at import from the working directory,
+# so every test imports it afresh over a copy of this directory's data files in a scratch directory
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_FILES = ["Food survey.csv", "temp_dish_inventory.csv"]
+
+
+@pytest.fixture
+def web(tmp_path, monkeypatch):
+    for name in DATA_FILES:
+        shutil.copy(os.path.join(HERE, name), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(HERE)
+    for name in ('app', 'recommender'):
+        sys.modules.pop(name, None)
+    module = importlib.import_module('app')
+    module.app.testing = True
+    # Built up front: a lazy build takes the writer, which makes read_state run the request's reader again
+    module.recommender.current_similarity()
+    yield module
+    module.stop_feedback_worker()
+    module.recommender.close_journal()
+    for name in ('app', 'recommender'):
+        sys.modules.pop(name, None)
+
+
+@pytest.fixture
+def client(web):
+    return web.app.test_client()
+
+
+# Function to pick survey users with at least n dishes rated below 3, who get n ranked dishes from a full pantry
+def ranked_users(engine, n=3):
+    return [int(user_id) for user_id in engine.user_index if (engine.rating_row(user_id) < 3).sum() >= n]
+
+
+def test_dishes_and_ingredients(web, client):
+    response = client.get('/api/v1/dishes')
+    assert response.status_code == 200
+    assert response.json['dishes'] == list(web.recommender.dish_names)
+    assert set(response.json['meal_times']) == set(web.recommender.meal_time_columns)
+
+    response = client.get('/api/v1/ingredients')
+    assert response.status_code == 200
+    assert response.json == {'ingredients': list(web.recommender.ingredient_columns)}
+
+
+@pytest.mark.parametrize('path', ['/api/v1/dishes', '/api/v1/ingredients'])
+def test_current_etag_gets_not_modified(client, path):
+    etag = client.get(path).headers['ETag']
+    assert etag.startswith('W/')
+
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert client.get(path, headers={'If-None-Match': 'W/"other"'}).status_code == 200
+
+
+def test_large_bodies_are_gzipped(web, client, monkeypatch):
+    monkeypatch.setattr(web, 'API_GZIP_MIN_BYTES', 256)
+    plain = client.get('/api/v1/dishes')
+    assert 'Content-Encoding' not in plain.headers
+    assert len(plain.data) >= web.API_GZIP_MIN_BYTES
+
+    response = client.get('/api/v1/dishes', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == plain.data
+
+    # Small bodies go out as they are
+    user_id = int(web.recommender.user_index[0])
+    response = client.get(f'/api/v1/users/{user_id}', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.json['user_id'] == user_id
+
+
+def test_create_user(web, client):
+    response = client.post('/api/v1/users', json={'user_id': 900001, 'name': 'new', 'ingredients': ['Rice']})
+    assert response.status_code == 201
+    assert response.json == {'user_id': 900001}
+    assert web.recommender.validate_user(900001)
+
+    response = client.post('/api/v1/users', json={'user_id': 900001, 'name': 'again'})
+    assert response.status_code == 409
+    assert web.recommender.users[900001] == 'new'
+
+    response = client.get('/api/v1/users/900001')
+    assert response.status_code == 200
+    assert response.json == {'user_id': 900001, 'name': 'new', 'recent': []}
+
+
+@pytest.mark.parametrize('method, path, body', [
+    ('post', '/api/v1/users', {'user_id': 'abc'}),
+    ('post', '/api/v1/users', [1, 2]),
+    ('get', '/api/v1/recommendations?user_id=abc', None),
+    ('get', '/api/v1/recommendations?user_id=1&n=0', None),
+    ('post', '/api/v1/recommendations', {'requests': {'user_id': 1}}),
+    ('post', '/api/v1/feedback', {'user_id': 1, 'dish_id': -1}),
+    ('post', '/api/v1/feedback', {'user_id': 1, 'dish_id': 'soup'}),
+])
+def test_bad_requests(client, method, path, body):
+    response = getattr(client, method)(path, json=body)
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+def test_unknown_user(client):
+    assert client.get('/api/v1/users/999999').status_code == 404
+    assert client.get('/api/v1/recommendations?user_id=999999').status_code == 404
+    assert client.post('/api/v1/feedback', json={'user_id': 999999, 'dish_id': 0}).status_code == 400
+
+
+def test_too_large_batch(web, client):
+    events = [{'user_id': 1, 'dish_id': 0}] * (web.API_MAX_BATCH + 1)
+    assert client.post('/api/v1/feedback', json={'events': events}).status_code == 413
+
+
+def test_recommendations_are_cached(web, client):
+    engine = web.recommender
+    user_id = ranked_users(engine)[0]
+    url = f'/api/v1/recommendations?user_id={user_id}&ingredients={",".join(engine.ingredient_columns)}&n=3'
+
+    first = client.get(url)
+    assert first.status_code == 200
+    assert first.json['user_id'] == user_id and len(first.json['dish_ids']) == 3
+    assert engine.event_counts[('recommendations', 'ranked')] == 1
+    hits = engine.recommendation_cache_stats['hits']
+
+    second = client.get(url)
+    assert second.json == first.json
+    assert engine.recommendation_cache_stats['hits'] == hits + 1
+    assert engine.event_counts[('recommendations', 'cached_ranked')] == 1
+
+
+def test_batch_recommendations(web, client):
+    engine = web.recommender
+    users = ranked_users(engine)[:3]
+    everything = list(engine.ingredient_columns)
+    requests = [{'user_id': user_id, 'ingredients': everything} for user_id in users]
+    requests.append({'user_id': 999999})
+    requests.append({'user_id': users[0], 'ingredients': [], 'meal_time': 'Lunch'})
+
+    response = client.post('/api/v1/recommendations', json={'n': 3, 'requests': requests},
+                           headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    results = json.loads(gzip.decompress(response.data) if 'Content-Encoding' in response.headers else response.data)
+    results = results['recommendations']
+    assert [result['user_id'] for result in results] == users + [999999, users[0]]
+    assert results[3] == {'user_id': 999999, 'error': "unknown user"}
+
+    # Every known user is counted once under the path that answered them, the empty pantry under a fallback
+    counts = {label: value for (event, label), value in engine.event_counts.items() if event == 'recommendations'}
+    assert counts.get('ranked', 0) == 3 and counts.get('partial', 0) + counts.get('retry', 0) == 1
+    assert engine.stage_seconds['batch_ranking'][0] == 1
+
+    # The same answer as one user at a time
+    for user_id, result in zip(users, results):
+        single = client.get('/api/v1/recommendations', query_string={'user_id': user_id, 'n': 3,
+                                                                     'ingredients': ",".join(everything)})
+        assert single.json == result
+
+
+def test_feedback_is_queued_and_applied(web, client):
+    engine = web.recommender
+    user_id = int(engine.user_index[0])
+    response = client.post('/api/v1/feedback', json={'events': [{'user_id': user_id, 'dish_id': 2},
+                                                                {'user_id': user_id, 'dish_id': 4}]})
+    assert response.status_code == 202
+    assert response.json == {'accepted': 2}
+
+    web.flush_feedback()
+    assert engine.recent_selections(user_id)[-2:] == [2, 4]
+    assert client.get(f'/api/v1/users/{user_id}').json['recent'][-2:] == [2, 4]
+
+
+def test_feedback_and_metrics_skip_catch_up(web, client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(web.recommender, 'catch_up', lambda: calls.append(True))
+    user_id = int(web.recommender.user_index[0])
+
+    assert client.get(f'/select_dish/{user_id}/2').status_code == 302
+    assert client.post('/api/v1/feedback', json={'user_id': user_id, 'dish_id': 3}).status_code == 202
+    assert client.get('/metrics').status_code == 200
+    assert calls == []
+
+    # Reads catch up, and so does feedback naming an id this process does not know yet
+    client.get('/api/v1/dishes')
+    assert len(calls) == 1
+    client.post('/api/v1/feedback', json={'user_id': 999999, 'dish_id': 3})
+    assert len(calls) == 2
+
+
+def test_stopping_the_worker_applies_queued_feedback(web):
+    user_id = int(web.recommender.user_index[0])
+    for dish_id in (5, 6, 7):
+        web.enqueue_feedback(user_id, dish_id)
+
+    web.stop_feedback_worker()
+    assert not web.feedback_worker.is_alive()
+    assert web.recommender.recent_selections(user_id) == [5, 6, 7]
+    assert web.feedback_stats['applied'] == 3
@@ -0,0 +1,63 @@
+import hashlib
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+#! Disk cache for what the engine (recommender.py) would otherwise rebuild on every start. An artifact is an .npz
+#! under ARTIFACT_DIR (next to the engine's data files) saved with the key it was built for: a hash of every input
+#! and setting that went into it, so a changed rating, inventory row or setting is a miss and the artifact is rebuilt
+ARTIFACT_DIR = "artifacts"
+
+
+#! Function to hash arrays (dtype, shape and contents) and plain values (their repr) into a key
+def artifact_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            digest.update(f"{part.dtype.str}{part.shape}".encode())
+            digest.update(memoryview(part).cast('B'))
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+#! Function to get the path an artifact is saved at
+def artifact_path(name):
+    return os.path.join(ARTIFACT_DIR, name + ".npz")
+
+
+#! Function to load an artifact's arrays, None when there is no key, no file or the file was built for another key
+def load_artifact(name, key):
+    path = artifact_path(name)
+    if key is None or not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if str(saved['key']) != key:
+            return None
+        return {field: saved[field] for field in saved.files if field != 'key'}
+
+
+#! Function to write a file in place of path all at once: it is written to a temporary file of this process (web
+#! workers may write the same path at the same time) and renamed over path once complete. The rename is atomic, so a
+#! crash never leaves a truncated file; a write that fails leaves path as it was
+@contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, mode, **kwargs) as f:
+            yield f
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+#! Function to save an artifact's arrays under a key
+def save_artifact(name, key, arrays):
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    with atomic_write(artifact_path(name), 'wb') as f:
+        np.savez(f, key=np.array(key), **arrays)
@@ -0,0 +1,226 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  #? Windows: no max RSS, the tracemalloc peaks are still reported
+    resource = None
+
+#! Benchmarks for the recommendation hot paths of the engine (recommender.py) on synthetic data. The generators write
+#! a survey CSV and a dish inventory with the same column layout as the real ones into a scratch directory, the engine
+#! is imported there, and every case reports p50/p99 latency plus the peak memory allocated while it runs.
+#! Results are written as JSON so two runs can be diffed:
+#!     python benchmark.py --users 5000 --dishes 500 --ingredients 120 --output before.json
+
+MEAL_TIMES = ['Breakfast', 'Lunch', 'Dinner', 'Snacks']
+MEMORY_ITERATIONS = 3
+
+
+#! Function to generate a survey matrix: density is the share of cells a user actually rated, the rest are left
+#! empty and read as the cold-start prior once the engine is loaded
+def generate_survey(num_users, num_dishes, density, rng):
+    dish_names = [f"Dish {i}" for i in range(num_dishes)]
+
+    #? Dishes have a base appeal and users a bias, so the similarity has some structure to find
+    appeal = rng.normal(3.2, 0.6, num_dishes)
+    bias = rng.normal(0, 0.5, num_users)
+    ratings = np.round(np.clip(appeal[None, :] + bias[:, None] + rng.normal(0, 0.8, (num_users, num_dishes)), 1, 5), 1)
+
+    observed = rng.random((num_users, num_dishes)) < density
+    observed[np.arange(num_users), rng.integers(0, num_dishes, num_users)] = True  #? Every user rated something
+
+    survey = pd.DataFrame(np.where(observed, ratings, np.nan), columns=dish_names)
+    survey.insert(0, 'UserID', np.arange(1, num_users + 1))
+    return survey
+
+
+#! Function to generate a dish inventory: Items, Item_id, one 0/1 column per ingredient, then the meal times
+def generate_inventory(num_dishes, num_ingredients, ingredients_per_dish, rng):
+    ingredient_names = [f"Ingredient {j}" for j in range(num_ingredients)]
+
+    uses = np.zeros((num_dishes, num_ingredients), dtype=int)
+    counts = np.clip(rng.poisson(ingredients_per_dish, num_dishes), 1, num_ingredients)
+    for i, count in enumerate(counts):
+        uses[i, rng.choice(num_ingredients, count, replace=False)] = 1
+
+    served = rng.random((num_dishes, len(MEAL_TIMES))) < 0.4
+    served[np.arange(num_dishes), rng.integers(0, len(MEAL_TIMES), num_dishes)] = True
+
+    inventory = pd.DataFrame(uses, columns=ingredient_names)
+    inventory.insert(0, 'Item_id', np.arange(1, num_dishes + 1))
+    inventory.insert(0, 'Items', [f"Dish {i}" for i in range(num_dishes)])
+    for k, meal_time in enumerate(MEAL_TIMES):
+        inventory[meal_time] = served[:, k].astype(int)
+    return inventory
+
+
+#! Function to load the engine against the synthetic files in the current directory
+def load_engine(dense_similarity_limit=None):
+    sys.modules.pop('recommender', None)
+    engine = importlib.import_module('recommender')
+    if dense_similarity_limit is not None:
+        engine.DENSE_SIMILARITY_LIMIT = dense_similarity_limit
+
+    engine.load_state()
+    engine.rebuild_similarity()
+    return engine
+
+
+#! Function to time one case: latencies in milliseconds over the timed iterations, then the peak traced
+#! allocation over a few extra iterations (tracemalloc slows the calls down, so it stays out of the timings)
+def run_case(setup, call, iterations, warmup=1):
+    for _ in range(warmup):
+        call(*setup())
+
+    timings = []
+    for _ in range(iterations):
+        args = setup()
+        start = time.perf_counter()
+        call(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    peak = 0
+    for _ in range(MEMORY_ITERATIONS):
+        args = setup()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        call(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    timings = np.array(timings)
+    return {
+        'iterations': iterations,
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p99_ms': float(np.percentile(timings, 99)),
+        'mean_ms': float(timings.mean()),
+        'max_ms': float(timings.max()),
+        'peak_memory_bytes': int(peak),
+    }
+
+
+#! Function to run every case against a loaded engine
+def run_benchmarks(engine, iterations, build_iterations, rng):
+    user_ids = np.asarray(engine.user_index)
+    num_dishes = len(engine.dish_names)
+    ingredient_columns = engine.ingredient_columns
+
+    def random_user():
+        return int(rng.choice(user_ids))
+
+    def random_pantry():
+        count = int(rng.integers(1, len(ingredient_columns) + 1))
+        return [ingredient_columns[j] for j in rng.choice(len(ingredient_columns), count, replace=False)]
+
+    def random_meal_time():
+        return {MEAL_TIMES[int(rng.integers(len(MEAL_TIMES)))]}
+
+    def recommendation_args():
+        return random_user(), random_pantry(), random_meal_time()
+
+    def uncached_recommendations(user_id, pantry, meal_time):
+        engine.clear_recommendation_cache()
+        engine.recommend(user_id, pantry, meal_time)
+
+    def retry_args():
+        user_id = random_user()
+        scores = engine.rating_row(user_id)
+        candidates = (scores < 3) & ~engine.recent_mask(user_id, num_dishes)
+        recommendations = [(int(i), scores[i]) for i in engine.top_n_dishes(scores, candidates, num_dishes)]
+        cookable = engine.cookable_dishes(engine.build_pantry_mask(random_pantry()))[:num_dishes]
+        return user_id, recommendations, cookable
+
+    new_user_ids = iter(range(int(user_ids.max()) + 1, sys.maxsize))
+
+    cases = [
+        ('cosine_similarity_build', lambda: (), engine.rebuild_similarity, build_iterations),
+        ('select_neighborhood', lambda: (engine.current_similarity(), int(rng.integers(num_dishes)), 5),
+         engine.select_neighborhood, iterations),
+        ('check_ingredients', lambda: (int(rng.integers(num_dishes)), random_pantry()),
+         engine.check_ingredients, iterations),
+        ('get_recommendations', recommendation_args, uncached_recommendations, iterations),
+        ('get_recommendations_cached', lambda: (user_ids[0], ingredient_columns, None), engine.recommend, iterations),
+        ('retry_cosine_similarity', retry_args, engine.retry_cosine_similarity, iterations),
+        ('update_data', lambda: (random_user(), int(rng.integers(num_dishes)), int(rng.integers(1, 6))),
+         engine.update_data, iterations),
+        ('add_user', lambda: (next(new_user_ids), 'benchmark'), engine.add_user, iterations),
+    ]
+
+    results = {}
+    for name, setup, call, count in cases:
+        results[name] = run_case(setup, call, count)
+        print(f"{name:28s} p50 {results[name]['p50_ms']:10.3f} ms   p99 {results[name]['p99_ms']:10.3f} ms"
+              f"   peak {results[name]['peak_memory_bytes'] / 1e6:10.2f} MB", file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation hot paths on synthetic data")
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--dishes', type=int, default=16)
+    parser.add_argument('--ingredients', type=int, default=31)
+    parser.add_argument('--ingredients-per-dish', type=float, default=3.0)
+    parser.add_argument('--density', type=float, default=1.0, help="share of survey cells that are real ratings")
+    parser.add_argument('--dense-similarity-limit', type=int,
+                        help="catalogue size above which the sparse top-K similarity is used (0 to always use it)")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--build-iterations', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        survey = generate_survey(args.users, args.dishes, args.density, rng)
+        inventory = generate_inventory(args.dishes, args.ingredients, args.ingredients_per_dish, rng)
+        survey.to_csv(os.path.join(scratch, "Food survey.csv"), index=False)
+        inventory.to_csv(os.path.join(scratch, "temp_dish_inventory.csv"), index=False)
+
+        os.chdir(scratch)
+        try:
+            start = time.perf_counter()
+            engine = load_engine(args.dense_similarity_limit)
+            load_seconds = time.perf_counter() - start
+
+            results = run_benchmarks(engine, args.iterations, args.build_iterations, rng)
+            engine.close_journal()  #? Before the scratch directory goes away
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+        },
+        'load_seconds': load_seconds,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
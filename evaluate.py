@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  #? Windows: no max RSS
+    resource = None
+
+from benchmark import load_engine
+
+#! Offline evaluation of the engine. A share of every user's ratings in the survey is held out and left empty (so it
+#! reads as the cold-start prior, the dish mean of the rest), the engine is loaded on that training split in
+#! a scratch directory, and every scorer recommends k dishes for every user across forked worker processes. The
+#! held-out ratings at or above the relevance threshold are the hits to find:
+#!     python evaluate.py --engines ratings factors --output before.json
+#! A logged sequence of feedback events (UserID, Dish, Rating; the dish by name or id) can be replayed through
+#! update_data before the recommendations are made. The split, the replay and the recommendations are all
+#! deterministic for a seed, and each engine's recommendations are hashed so a change that should not move them
+#! can be checked in one run.
+
+TEST_FRACTION = 0.2
+RELEVANT_RATING = 4.0
+K = 5
+
+model = None  #? The loaded engine, shared with the forked workers
+
+
+#! Function to split the survey: a (users x dishes) mask of held-out cells, at least one rating left per user
+def split_ratings(ratings, test_fraction, rng):
+    observed = ~np.isnan(ratings)
+    held_out = observed & (rng.random(ratings.shape) < test_fraction)
+
+    #? A user with everything held out keeps one rating back in training
+    emptied = np.flatnonzero(observed.any(axis=1) & ~(observed & ~held_out).any(axis=1))
+    for row in emptied:
+        held_out[row, rng.choice(np.flatnonzero(observed[row]))] = False
+    return held_out
+
+
+#! Function to build the training survey: the held-out cells are emptied
+def training_survey(survey, held_out):
+    ratings = survey.drop(columns=['UserID']).values.astype(float)
+    train = pd.DataFrame(np.where(held_out, np.nan, ratings), columns=survey.columns[1:])
+    train.insert(0, 'UserID', survey['UserID'].values)
+    return train
+
+
+#! Function to replay feedback events through update_data in file order, skipping unknown users and dishes
+def replay_events(path):
+    events = pd.read_csv(path, skipinitialspace=True)
+    dish_ids = {dish: i for i, dish in enumerate(model.dish_names)}
+    stats = {'events': len(events), 'applied': 0, 'skipped': 0}
+
+    start = time.perf_counter()
+    for user_id, dish, rating in events[['UserID', 'Dish', 'Rating']].itertuples(index=False):
+        dish_id = dish_ids.get(dish, int(dish) if str(dish).isdigit() else -1)
+        if user_id not in model.user_index or not 0 <= dish_id < len(model.dish_names):
+            stats['skipped'] += 1
+            continue
+        model.update_data(int(user_id), dish_id, int(rating))
+        stats['applied'] += 1
+    stats['seconds'] = time.perf_counter() - start
+    stats['events_per_second'] = stats['applied'] / stats['seconds'] if stats['seconds'] > 0 else None
+
+    #? Two replays of the same log must end in the same ratings
+    stats['ratings_sha256'] = hashlib.sha256(np.ascontiguousarray(model.rating_rows(model.user_index), dtype=float).tobytes()).hexdigest()
+    return stats
+
+
+#! Function to recommend k dishes for each of a block of users with every ingredient available and no meal time filter
+def recommend_users(user_ids, k, engine):
+    pantry = model.ingredient_columns
+    return [[i for i, _ in model.recommend(int(user_id), pantry, None, k, engine)[1]] for user_id in user_ids]
+
+
+#! Function to recommend for every user, in forked worker processes that share the loaded engine when there are several
+def recommend_all(user_ids, k, engine, workers):
+    blocks = [block for block in np.array_split(np.asarray(user_ids), max(1, workers * 4)) if len(block)]
+    if workers <= 1 or len(blocks) <= 1:
+        return [dish_ids for block in blocks for dish_ids in recommend_users(block, k, engine)]
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        results = pool.map(recommend_users, blocks, [k] * len(blocks), [engine] * len(blocks))
+        return [dish_ids for result in results for dish_ids in result]
+
+
+#! Function to score the recommendations against the held-out ratings: precision, recall and NDCG at k over the
+#! users with a relevant held-out dish, and the share of the catalogue recommended to anyone
+def score_recommendations(recommendations, relevant, k):
+    precision, recall, ndcg = [], [], []
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+
+    for dish_ids, row in zip(recommendations, relevant):
+        if not row.any():
+            continue
+        hits = row[dish_ids] if dish_ids else np.zeros(0, dtype=bool)
+        precision.append(hits.sum() / k)
+        recall.append(hits.sum() / row.sum())
+        ndcg.append((discounts[:len(hits)] * hits).sum() / discounts[:min(int(row.sum()), k)].sum())
+
+    recommended = {dish_id for dish_ids in recommendations for dish_id in dish_ids}
+    return {
+        'users_evaluated': len(precision),
+        f'precision@{k}': float(np.mean(precision)) if precision else None,
+        f'recall@{k}': float(np.mean(recall)) if recall else None,
+        f'ndcg@{k}': float(np.mean(ndcg)) if ndcg else None,
+        'coverage': len(recommended) / relevant.shape[1],
+        'empty': sum(not dish_ids for dish_ids in recommendations),
+    }
+
+
+def main():
+    global model
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Evaluate recommendation quality and throughput on a held-out split of the survey")
+    parser.add_argument('--survey', default=os.path.join(repo, "Food survey.csv"))
+    parser.add_argument('--inventory', default=os.path.join(repo, "temp_dish_inventory.csv"))
+    parser.add_argument('--engines', nargs='+', default=['ratings'], help="scorers from RECOMMENDATION_ENGINES")
+    parser.add_argument('--k', type=int, default=K)
+    parser.add_argument('--test-fraction', type=float, default=TEST_FRACTION)
+    parser.add_argument('--relevant-rating', type=float, default=RELEVANT_RATING)
+    parser.add_argument('--replay', help="CSV of feedback events (UserID, Dish, Rating) to apply before recommending")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    survey = pd.read_csv(args.survey)
+    ratings = survey.drop(columns=['UserID']).values.astype(float)
+    held_out = split_ratings(ratings, args.test_fraction, rng)
+    relevant = held_out & (np.nan_to_num(ratings) >= args.relevant_rating)
+    train = training_survey(survey, held_out)
+
+    replay = os.path.abspath(args.replay) if args.replay else None
+    sys.path.insert(0, repo)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        train.to_csv(os.path.join(scratch, "Food survey.csv"), index=False)
+        shutil.copy(args.inventory, os.path.join(scratch, "temp_dish_inventory.csv"))
+
+        os.chdir(scratch)
+        try:
+            start = time.perf_counter()
+            model = load_engine()
+            replay_stats = replay_events(replay) if replay else None
+            load_seconds = time.perf_counter() - start
+
+            user_ids = list(model.user_index)
+            model.current_similarity()  #? Caught up once here rather than in every worker
+
+            results = {}
+            for engine in args.engines:
+                if engine == 'factors':
+                    model.current_factors()  #? Trained once here rather than in every worker
+
+                start = time.perf_counter()
+                recommendations = recommend_all(user_ids, args.k, engine, args.workers)
+                seconds = time.perf_counter() - start
+
+                results[engine] = score_recommendations(recommendations, relevant, args.k)
+                results[engine].update({
+                    'seconds': seconds,
+                    'users_per_second': len(user_ids) / seconds if seconds > 0 else None,
+                    'recommendations_sha256': hashlib.sha256(json.dumps(recommendations).encode()).hexdigest(),
+                })
+                print(f"{engine:10s} precision@{args.k} {results[engine][f'precision@{args.k}'] or 0:.4f}"
+                      f"   recall@{args.k} {results[engine][f'recall@{args.k}'] or 0:.4f}"
+                      f"   ndcg@{args.k} {results[engine][f'ndcg@{args.k}'] or 0:.4f}"
+                      f"   coverage {results[engine]['coverage']:.3f}"
+                      f"   {results[engine]['users_per_second'] or 0:10.1f} users/s", file=sys.stderr)
+
+            model.close_journal()  #? Before the scratch directory goes away
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+        },
+        'split': {
+            'users': len(survey),
+            'held_out': int(held_out.sum()),
+            'relevant': int(relevant.sum()),
+        },
+        'load_seconds': load_seconds,
+        'replay': replay_stats,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None,
+        'max_worker_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource is not None else None,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
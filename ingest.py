@@ -0,0 +1,168 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+#! Streaming import of survey responses and dish inventories into the live store. Files are read in chunks, so the
+#! input is never held in memory whole; each chunk is validated, its column names normalized and reconciled with the
+#! live ones, and merged with merge_ratings / merge_inventory (one batched similarity update per chunk, no recompute).
+#! The result is persisted once at the end:
+#!     python ingest.py survey responses.csv
+#!     python ingest.py inventory Dish_Inventory.csv --target web
+
+CHUNK_SIZE = 10000
+MIN_RATING = 1
+MAX_RATING = 5
+
+ENGINES = {
+    'main': '.',
+    'web': 'Web App',
+}
+
+
+class SchemaError(ValueError):
+    pass
+
+
+#! Function to import the engine from the directory whose data files it should work on (the CLI's or the web app's)
+def load_engine(target):
+    repo = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(os.path.join(repo, ENGINES[target]))
+    sys.path.insert(0, repo)
+    engine = importlib.import_module('recommender')
+    engine.load_state()
+    return engine
+
+
+#! Function to map each (normalized) input column to a live column, matching case-insensitively; unmatched ones map to None
+def reconcile_columns(columns, live_columns):
+    live = {column.casefold(): column for column in live_columns}
+    return {column: live.get(column.casefold()) for column in columns}
+
+
+#! Function to read a CSV in chunks with normalized column names
+def read_chunks(path, engine, chunk_size):
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str, skipinitialspace=True):
+        yield chunk.rename(columns=engine.normalize_column)
+
+
+#! Function to parse integer ids; rows whose id is missing or not a whole number come back as invalid
+def parse_ids(values):
+    ids = pd.to_numeric(values, errors='coerce')
+    valid = ids.notna() & (ids == ids.round())
+    return ids.fillna(-1).astype(np.int64), valid.values
+
+
+#! Function to stream a survey CSV (UserID plus one column per dish) into the ratings
+def import_survey(engine, path, chunk_size=CHUNK_SIZE):
+    stats = {'chunks': 0, 'rows': 0, 'skipped_rows': 0, 'invalid_ratings': 0, 'users_added': 0, 'users_updated': 0,
+             'unknown_columns': []}
+
+    mapping = None
+    for chunk in read_chunks(path, engine, chunk_size):
+        if mapping is None:
+            id_column = reconcile_columns(chunk.columns, ['UserID'])
+            id_column = next((column for column, match in id_column.items() if match), None)
+            if id_column is None:
+                raise SchemaError(f"{path}: no UserID column")
+            mapping = reconcile_columns([column for column in chunk.columns if column != id_column], engine.dish_names)
+            stats['unknown_columns'] = [column for column, dish in mapping.items() if dish is None]
+            mapping = {column: dish for column, dish in mapping.items() if dish is not None}
+            if not mapping:
+                raise SchemaError(f"{path}: no column matches a known dish")
+
+        user_ids, valid = parse_ids(chunk[id_column])
+        ratings = chunk[list(mapping)].apply(pd.to_numeric, errors='coerce')
+        out_of_range = ratings.notna() & ((ratings < MIN_RATING) | (ratings > MAX_RATING))
+        stats['invalid_ratings'] += int((chunk[list(mapping)].notna() & ratings.isna()).values.sum() + out_of_range.values.sum())
+        ratings = ratings.mask(out_of_range)
+
+        batch = pd.DataFrame(ratings.values[valid], columns=list(mapping.values()),
+                             index=pd.Index(user_ids.values[valid], name='UserID'))
+        with engine.state_writer():
+            known = batch.index.isin(engine.user_index)
+            engine.merge_ratings(batch)
+
+        stats['chunks'] += 1
+        stats['rows'] += len(chunk)
+        stats['skipped_rows'] += int((~valid).sum())
+        stats['users_added'] += int(len(set(batch.index[~known])))
+        stats['users_updated'] += int(len(set(batch.index[known])))
+
+    with engine.state_writer():
+        engine.compact_journal()
+    return stats
+
+
+#! Function to stream an inventory CSV (Items, Item_id, ingredient columns, optional attribute columns, meal time columns)
+#! into the ingredient index
+def import_inventory(engine, path, chunk_size=CHUNK_SIZE):
+    stats = {'chunks': 0, 'rows': 0, 'skipped_rows': 0, 'invalid_cells': 0, 'new_ingredients': [], 'dishes_added': 0}
+
+    mapping = None
+    for chunk in read_chunks(path, engine, chunk_size):
+        if mapping is None:
+            fixed = ['Items', 'Item_id'] + list(engine.meal_time_columns)
+            mapping = reconcile_columns(chunk.columns, fixed + engine.DISH_ATTRIBUTES + list(engine.ingredient_columns))
+            missing = set(fixed) - set(mapping.values())
+            if missing:
+                raise SchemaError(f"{path}: missing column(s) {', '.join(sorted(missing))}")
+            #? An ingredient nobody has seen yet keeps its normalized name and becomes a new column
+            stats['new_ingredients'] = [column for column, match in mapping.items() if match is None]
+            mapping = {column: match or column for column, match in mapping.items()}
+
+        chunk = chunk.rename(columns=mapping)
+        item_ids, valid = parse_ids(chunk['Item_id'])
+        flags = chunk.drop(columns=['Items', 'Item_id']).apply(pd.to_numeric, errors='coerce')
+        #? Ingredients and meal times are 0/1 flags, attributes any number
+        attributes = [column for column in flags.columns if column in engine.DISH_ATTRIBUTES]
+        invalid = ~flags.isin([0, 1])
+        invalid[attributes] = flags[attributes].isna()
+        stats['invalid_cells'] += int(invalid.values.sum())
+        flags = flags.mask(invalid, 0)
+        flags = flags.astype({column: int for column in flags.columns if column not in attributes})
+
+        rows = flags[valid]
+        rows.insert(0, 'Item_id', item_ids.values[valid])
+        rows.insert(0, 'Items', chunk['Items'].values[valid])
+        with engine.state_writer():
+            stats['dishes_added'] += engine.merge_inventory(rows.reset_index(drop=True))
+
+        stats['chunks'] += 1
+        stats['rows'] += len(chunk)
+        stats['skipped_rows'] += int((~valid).sum())
+
+    with engine.state_writer():
+        engine.save_inventory()
+        if stats['dishes_added']:
+            #? The survey CSV carries the new rating columns from here on
+            engine.compact_journal()
+    return stats
+
+
+IMPORTERS = {'survey': import_survey, 'inventory': import_inventory}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream survey responses or dish inventory rows into the live store")
+    parser.add_argument('kind', choices=sorted(IMPORTERS))
+    parser.add_argument('path')
+    parser.add_argument('--target', choices=sorted(ENGINES), default='main')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.path)
+    engine = load_engine(args.target)
+    try:
+        stats = IMPORTERS[args.kind](engine, path, args.chunk_size)
+    except SchemaError as e:
+        sys.exit(str(e))
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
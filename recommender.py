@@ -0,0 +1,2340 @@
+import atexit
+import csv
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+from artifacts import artifact_key, atomic_write, load_artifact, save_artifact
+
+try:
+    import fcntl
+except ImportError:  #? Windows: no cross-process lock, fine for a single process
+    fcntl = None
+
+#! The recommendation engine behind both entry points, the command line (main.py) and the web app (Web App/app.py):
+#! the ratings and their journal, the dish similarity, the ingredient index, the cold-start priors, the factor scorer
+#! and the recommendation and feedback paths. State lives in module globals and in data files relative to the working
+#! directory, so each entry point imports it from the directory that holds its data and calls load_state() (see the end
+#! of the file) before anything else. Every change goes through state_writer, which also keeps several processes over
+#! the same files in step
+
+
+#! Instrumentation: call counts and total seconds per hot-path stage plus event counters, per process. With
+#! METRICS_ENABLED off the timers and counters return before touching the clock or the lock
+METRICS_ENABLED = True
+
+metrics_lock = threading.Lock()
+stage_seconds = {}  #? stage -> [calls, total seconds]
+event_counts = {}  #? (event, label) -> count
+stage_observers = []  #? Called with (stage, seconds) after every recorded stage, e.g. for per-request timings
+
+
+#! Function to record a stage that began at perf_counter() value start
+def observe(stage, start):
+    elapsed = time.perf_counter() - start
+    with metrics_lock:
+        totals = stage_seconds.setdefault(stage, [0, 0.0])
+        totals[0] += 1
+        totals[1] += elapsed
+    for observer in stage_observers:
+        observer(stage, elapsed)
+
+
+#! Function to time a whole function as a stage (the decorator form of observe)
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS_ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(stage, start)
+        return wrapper
+    return decorator
+
+
+#! Function to count an event
+def count(event, label=None, amount=1):
+    if METRICS_ENABLED:
+        with metrics_lock:
+            event_counts[(event, label)] = event_counts.get((event, label), 0) + amount
+
+
+#! Rating changes go to an append-only journal that is replayed over the survey CSV at startup
+#! and compacted back into it every JOURNAL_COMPACT_EVERY records
+SURVEY_PATH = "Food survey.csv"
+JOURNAL_PATH = "Food survey.journal"
+JOURNAL_SYNC_EVERY = 32
+JOURNAL_COMPACT_EVERY = 5000
+
+journal_file = None
+journal_pending = 0
+journal_records = 0
+journal_offset = 0
+journal_inode = None
+
+#! Cells without a rating are not stored: they read as the user's cold-start prior (see rating_row), so they stay out
+#! of the similarity and the priors and are written as empty cells in the survey CSV. A user who signed up with
+#! ingredients or meal times keeps that segment for their prior: user_id -> (ingredients, meal times) as frozensets
+SEGMENTS_PATH = "Food survey.segments.json"
+user_segments = {}
+
+
+#! Function to read the journal after a byte offset: (user_id, dish, rating) records, (time, user_id, dish) selections,
+#! (user_id, segment) sign-ups and the offset reached, stopping at a torn tail from a crash mid-append
+def read_journal(offset=0):
+    records = []
+    selections = []
+    joins = []
+    if not os.path.exists(JOURNAL_PATH):
+        return records, selections, joins, offset
+
+    with open(JOURNAL_PATH, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            row = next(csv.reader([line.decode()]))
+            if len(row) == 4 and row[3] == 'selected':
+                selections.append((float(row[0]), int(row[1]), row[2]))
+            elif len(row) == 5 and row[4] == 'joined':
+                joins.append((int(row[1]), (frozenset(filter(None, row[2].split('|'))),
+                                            frozenset(filter(None, row[3].split('|'))))))
+            elif len(row) == 4:
+                records.append((int(row[1]), row[2], float(row[3])))
+    return records, selections, joins, offset
+
+
+#! Function to group journal records by user, last value per cell wins: user_id -> {dish id: rating}
+def latest_records(records):
+    dish_ids = {dish: i for i, dish in enumerate(dish_names)}
+    latest = {}
+    for user_id, dish, rating in records:
+        cells = latest.setdefault(user_id, {})
+        if dish in dish_ids:
+            cells[dish_ids[dish]] = rating
+    return latest
+
+
+#! Function to replay the journal over the loaded store; users it does not know yet get a row of their own. Selection
+#! records ('selected' in place of a rating) are collected in journal_selections for the recent history
+def replay_journal():
+    global journal_records, journal_offset, journal_inode, journal_selections
+
+    records, journal_selections, joins, journal_offset = read_journal()
+    journal_inode = journal_identity()
+    journal_records = len(records) + len(journal_selections) + len(joins)
+
+    latest = latest_records(records)
+    user_segments.update((user_id, segment) for user_id, segment in joins if any(segment))
+    new_users = [user_id for user_id in dict.fromkeys([user_id for user_id, _ in joins] + list(latest))
+                 if user_id not in user_index]
+    new_rows = np.full((len(new_users), len(dish_names)), np.nan)
+    for row, user_id in enumerate(new_users):
+        cells = latest.get(user_id, {})
+        new_rows[row, list(cells)] = list(cells.values())
+    append_users(new_users, new_rows)
+
+    added = set(new_users)
+    for user_id, cells in latest.items():
+        if user_id not in added and cells:
+            store_cells(user_index.get_loc(user_id), list(cells), list(cells.values()))
+    return sum(len(cells) for cells in latest.values())
+
+
+#! Function to identify the journal file, so a compaction by another process (a new file) can be told apart from appends
+def journal_identity():
+    return os.stat(JOURNAL_PATH).st_ino if os.path.exists(JOURNAL_PATH) else None
+
+
+#! Function to append records to the journal, fsyncing every JOURNAL_SYNC_EVERY and compacting every JOURNAL_COMPACT_EVERY
+@timed('journal_write')
+def journal_rows(rows):
+    global journal_file, journal_pending, journal_records
+
+    if journal_file is None:
+        journal_file = open(JOURNAL_PATH, 'a', newline='')
+    csv.writer(journal_file).writerows(rows)
+    journal_file.flush()
+
+    journal_pending += len(rows)
+    journal_records += len(rows)
+    if journal_pending >= JOURNAL_SYNC_EVERY:
+        sync_journal()
+    if journal_records >= JOURNAL_COMPACT_EVERY:
+        compact_journal()
+
+
+#! Function to append a user's current ratings for the given dishes to the journal, after the selections (dish ids) that caused them
+def journal_ratings(user_id, dish_ids, selected=()):
+    timestamp = f"{time.time():.3f}"
+    ratings = rating_row(user_id)
+    journal_rows([[timestamp, user_id, dish_names[i], 'selected'] for i in selected] +
+                 [[timestamp, user_id, dish_names[i], repr(float(ratings[i]))] for i in dish_ids])
+
+
+#! Function to append a sign-up to the journal: the user and the segment of their cold-start prior, names joined by '|'
+def journal_join(user_id, segment):
+    ingredients, meal_times = segment
+    journal_rows([[f"{time.time():.3f}", user_id, '|'.join(sorted(ingredients)), '|'.join(sorted(meal_times)), 'joined']])
+
+
+#! Function to save the users' cold-start segments; the journal's sign-ups since are replayed on top
+def save_segments():
+    with atomic_write(SEGMENTS_PATH) as f:
+        json.dump({str(user_id): [sorted(ingredients), sorted(meal_times)]
+                   for user_id, (ingredients, meal_times) in user_segments.items()}, f)
+
+
+#! Function to load the saved cold-start segments
+def load_segments():
+    user_segments.clear()
+    if os.path.exists(SEGMENTS_PATH):
+        with open(SEGMENTS_PATH) as f:
+            for user_id, (ingredients, meal_times) in json.load(f).items():
+                user_segments[int(user_id)] = (frozenset(ingredients), frozenset(meal_times))
+
+
+#! Function to fsync the journal, batching the records written since the last sync
+@timed('journal_fsync')
+def sync_journal():
+    global journal_pending
+
+    if journal_file is not None and journal_pending:
+        os.fsync(journal_file.fileno())
+    journal_pending = 0
+
+
+#! Function to sync and close the journal file; the next record written opens it again
+def close_journal():
+    global journal_file
+
+    sync_journal()
+    if journal_file is not None:
+        journal_file.close()
+        journal_file = None
+
+
+#! Function to fold the journal into a fresh survey snapshot
+@timed('csv_persist')
+def compact_journal():
+    global journal_records, stored_ratings
+
+    sync_journal()
+    with atomic_write(SURVEY_PATH, newline='') as f:
+        write_survey(f)
+    export_ratings(user_index, dish_names, stored_ratings, RATINGS_PATH, csv_signature(SURVEY_PATH))
+    stored_ratings = read_ratings(RATINGS_PATH)[2]  #? The snapshot is exact, so its mapping replaces the private cells
+    save_priors()
+    save_recent()
+    save_segments()
+
+    #? Journal values are absolute, so replaying a journal that outlived the rename is harmless. The empty
+    #? journal is a new file, which is how other processes notice the compaction
+    close_journal()
+    with atomic_write(JOURNAL_PATH):
+        pass
+    journal_records = 0
+
+
+atexit.register(close_journal)
+
+
+#! Ratings live in one sparse (users x dishes) CSR matrix, stored_ratings, whose row r belongs to user_index[r]. A cell
+#! is stored when the user rated the dish; a cell without a rating takes no memory, so the store grows with the ratings
+#! given, not with users x dishes. The row offsets have spare room at the end, so a user without ratings is appended
+#! without copying the cells.
+#! Rows are read into dense (dishes,) vectors one user at a time, and writes touch only the cells that changed.
+#! After a load the store's arrays are the binary snapshot itself, mapped copy-on-write (see read_ratings), so the
+#! processes serving the same snapshot share one copy of the cells in the page cache
+SURVEY_BLOCK_SIZE = 4096  #? Users per block when the store is written out as the survey CSV
+
+indptr_buffer = None  #? The store's row offsets with room to grow, while stored_ratings.indptr is a view of its head
+
+
+#! Function to pack (users x dishes) ratings, NaN where a user has no value, as a CSR matrix of the stored cells
+def sparse_ratings(values):
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    rows, columns = np.nonzero(np.isfinite(values))
+    return sparse.csr_matrix((values[rows, columns], (rows, columns)), shape=values.shape)
+
+
+#! Function to get the scale of a store's cells: uint8 cells (the snapshot's layout) hold tenths of a star
+def cell_scale(matrix):
+    return 10 if matrix.data.dtype == np.uint8 else 1
+
+
+#! Function to express ratings in tenths of a star, or None if one is off the 0.1 grid or does not fit in a uint8
+def rating_tenths(values):
+    finite = np.isfinite(values)
+    tenths = np.round(values * 10)
+    if (tenths[finite] / 10 == values[finite]).all() and (tenths[finite] >= 0).all() and (tenths[finite] <= 255).all():
+        return tenths
+    return None
+
+
+#! Function to convert ratings to the cells of the store, tenths of a star while its cells are uint8. A rating the
+#! cells cannot hold first moves the store to float64 cells, a private copy of the values (the ids stay mapped)
+def cell_values(values):
+    global stored_ratings
+
+    values = np.asarray(values, dtype=float)
+    matrix = stored_ratings
+    if matrix.data.dtype == np.float64:
+        return values
+    tenths = rating_tenths(values) if matrix.data.dtype == np.uint8 else None
+    if tenths is not None:
+        return tenths
+    stored_ratings = sparse.csr_matrix((matrix.data / cell_scale(matrix), matrix.indices, matrix.indptr), shape=matrix.shape)
+    return values
+
+
+#! Function to pack (users x dishes) ratings as new rows for the store, in the store's cells
+def stored_block(values):
+    cells = cell_values(values)
+    return sparse_ratings(cells).astype(stored_ratings.data.dtype)
+
+
+#! Function to read rows of the store (positions) as dense ratings, NaN where there is no value
+def stored_rows(rows):
+    block = stored_ratings[rows]
+    values = np.full(block.shape, np.nan)
+    values[np.repeat(np.arange(block.shape[0]), np.diff(block.indptr)), block.indices] = block.data / cell_scale(block)
+    return values
+
+
+#! Function to write one user's stored ratings over a dense row of dishes (NaN, 0 or their cold-start prior)
+def fill_row(user_id, values):
+    matrix = stored_ratings
+    row = user_index.get_loc(user_id)
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    values[matrix.indices[start:end]] = matrix.data[start:end] / cell_scale(matrix)
+    return values
+
+
+#! Function to check whether a user rated every dish, so none of their cells reads as the cold-start prior
+def fully_rated(user_id):
+    row = user_index.get_loc(user_id)
+    return stored_ratings.indptr[row + 1] - stored_ratings.indptr[row] == len(dish_names)
+
+
+#! Function to read one user's ratings as a dense row, their cold-start prior where they have not rated the dish
+def rating_row(user_id):
+    if fully_rated(user_id):
+        return fill_row(user_id, np.empty(len(dish_names)))
+    return fill_row(user_id, cold_start_ratings(*user_segments.get(user_id, (None, None))))
+
+
+#! Function to read several users' ratings as dense rows, their cold-start prior where they have not rated the dish
+def rating_rows(user_ids):
+    values = observed_ratings(user_ids)
+    missing = np.isnan(values)
+    if missing.any():
+        values[missing] = np.broadcast_to(cold_start_ratings(), values.shape)[missing]
+        for row in [row for row, user_id in enumerate(user_ids) if user_id in user_segments] if user_segments else []:
+            prior = cold_start_ratings(*user_segments[user_ids[row]])
+            values[row, missing[row]] = prior[missing[row]]
+    return values
+
+
+#! Function to get users' (users x dishes) ratings with NaN wherever they have not rated the dish
+def observed_ratings(user_ids):
+    rows = user_index.get_indexer(user_ids)
+    if (rows < 0).any():
+        raise KeyError([user_id for user_id, row in zip(user_ids, rows) if row < 0])
+    return stored_rows(rows)
+
+
+#! Function to get a user's ratings as a dense row, with 0 where they have not rated the dish
+def observed_row(user_id):
+    return fill_row(user_id, np.zeros(len(dish_names)))
+
+
+#! Function to write some cells of one user's row (a position in the store). Stored cells are overwritten in place; new
+#! cells are inserted with one rebuild of the arrays, swapped in whole so a reader sees either the old or the new store
+def store_cells(row, dish_ids, values):
+    global stored_ratings
+
+    dish_ids = np.asarray(dish_ids, dtype=np.int64)
+    values = cell_values(values)
+    order = np.argsort(dish_ids, kind='stable')
+    dish_ids, values = dish_ids[order], values[order]
+
+    matrix = stored_ratings
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    positions = start + np.searchsorted(matrix.indices[start:end], dish_ids)
+    stored = positions < end
+    stored[stored] = matrix.indices[positions[stored]] == dish_ids[stored]
+    matrix.data[positions[stored]] = values[stored]
+    if stored.all():
+        return
+
+    new = ~stored
+    indptr = matrix.indptr.copy()
+    indptr[row + 1:] += new.sum()
+    stored_ratings = sparse.csr_matrix((np.insert(matrix.data, positions[new], values[new]),
+                                        np.insert(matrix.indices, positions[new], dish_ids[new]), indptr),
+                                       shape=matrix.shape)
+
+
+#! Function to replace whole rows of the store (positions) with (rows x dishes) ratings, NaN where there is no value
+def replace_rows(rows, values):
+    global stored_ratings
+
+    if not len(rows):
+        return
+    order = np.arange(len(user_index))
+    order[rows] = len(user_index) + np.arange(len(rows))
+    block = stored_block(values)
+    stored_ratings = sparse.vstack([stored_ratings, block], format='csr')[order]
+
+
+#! Function to add empty rows to the store: only the row offsets grow, in place while their buffer has room
+def append_empty_rows(count):
+    global stored_ratings, indptr_buffer
+
+    matrix = stored_ratings
+    num_rows = matrix.shape[0] + count
+    if indptr_buffer is None or matrix.indptr.base is not indptr_buffer or len(indptr_buffer) <= num_rows:
+        indptr_buffer = np.empty(max(2 * num_rows + 1, 1024), dtype=matrix.indptr.dtype)
+        indptr_buffer[:matrix.shape[0] + 1] = matrix.indptr
+    indptr_buffer[matrix.shape[0] + 1:num_rows + 1] = matrix.indptr[-1]
+    stored_ratings = sparse.csr_matrix((matrix.data, matrix.indices, indptr_buffer[:num_rows + 1]),
+                                       shape=(num_rows, matrix.shape[1]))
+
+
+#! Function to add rows for new users with (users x dishes) ratings, NaN where there is no value
+def append_users(user_ids, values):
+    global stored_ratings, user_index
+
+    if not len(user_ids):
+        return  #? Stacking nothing would still copy the store
+    #? The rows exist before the ids are published, so a reader never finds a user without a row
+    block = stored_block(values)
+    if block.nnz:
+        stored_ratings = sparse.vstack([stored_ratings, block], format='csr')
+    else:
+        append_empty_rows(len(user_ids))
+    user_index = user_index.append(pd.Index(user_ids, name='UserID'))
+
+
+#! Function to collect the ratings as a sparse (users x dishes) CSR matrix of stars. With rows (positions in the store)
+#! only those users' rows are collected, in that order
+def observed_matrix(rows=None):
+    matrix = stored_ratings if rows is None else stored_ratings[rows]
+    return sparse.csr_matrix((matrix.data / cell_scale(matrix), matrix.indices, matrix.indptr), shape=matrix.shape)
+
+
+#! The store is also kept on disk as a compact binary snapshot in the same CSR layout: the row offsets, the dish ids
+#! and the values of the stored cells (uint8 tenths of a star, float64 if a value is off the 0.1 grid). It is
+#! memory-mapped at startup instead of parsing the CSV, and rebuilt whenever the CSV changes
+RATINGS_PATH = "Food survey.ratings"
+RATINGS_MAGIC = b"MHRATE02"
+
+
+#! Function to describe a survey CSV so a binary snapshot can tell whether it is stale
+def csv_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+#! Function to lay out a snapshot: the byte offsets of the row offsets, dish ids and values, each 64-byte aligned
+def snapshot_offsets(header_size, header):
+    offsets = []
+    offset = len(RATINGS_MAGIC) + 8 + header_size
+    for count, dtype in ((len(header['users']) + 1, header['index_dtype']), (header['nnz'], header['index_dtype']),
+                         (header['nnz'], header['dtype'])):
+        offset = (offset + 63) // 64 * 64
+        offsets.append(offset)
+        offset += count * np.dtype(dtype).itemsize
+    return offsets
+
+
+#! Function to write a ratings store (user ids, dish names and the users x dishes CSR matrix) as a binary snapshot
+def export_ratings(index, columns, ratings, path=RATINGS_PATH, source=None):
+    values = ratings.data / cell_scale(ratings)
+    tenths = rating_tenths(values)
+    if tenths is not None:
+        data, dtype, scale = tenths.astype(np.uint8), 'uint8', 10
+    else:
+        data, dtype, scale = values, 'float64', 1
+    index_dtype = 'int32' if ratings.nnz < 2 ** 31 else 'int64'
+
+    header = {
+        'users': [int(user_id) for user_id in index],
+        'dishes': [str(dish) for dish in columns],
+        'nnz': int(ratings.nnz),
+        'index_dtype': index_dtype,
+        'dtype': dtype,
+        'scale': scale,
+        'source': source,
+    }
+    encoded = json.dumps(header).encode()
+    arrays = [ratings.indptr.astype(index_dtype), ratings.indices.astype(index_dtype), data]
+
+    with atomic_write(path, 'wb') as f:
+        f.write(RATINGS_MAGIC)
+        f.write(len(encoded).to_bytes(8, 'little'))
+        f.write(encoded)
+        for offset, array in zip(snapshot_offsets(len(encoded), header), arrays):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(array.tobytes())
+
+
+#! Function to memory-map a binary snapshot, returning its header and the row offsets, dish ids and values. The mapping
+#! is copy-on-write: a process that writes a cell gets a private copy of that page, and the file never changes
+def open_ratings(path=RATINGS_PATH):
+    with open(path, 'rb') as f:
+        if f.read(len(RATINGS_MAGIC)) != RATINGS_MAGIC:
+            raise ValueError(f"{path} is not a ratings snapshot")
+        header_size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_size))
+
+    arrays = []
+    for offset, (count, dtype) in zip(snapshot_offsets(header_size, header),
+                                      ((len(header['users']) + 1, header['index_dtype']),
+                                       (header['nnz'], header['index_dtype']), (header['nnz'], header['dtype']))):
+        if count:
+            arrays.append(np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=(count,)))
+        else:
+            arrays.append(np.zeros(0, dtype=dtype))
+    return header, arrays
+
+
+#! Function to read a binary snapshot back into a store: the user ids, the dish names and the CSR matrix of ratings,
+#! whose arrays are the mapped sections of the file rather than copies of them
+def read_ratings(path=RATINGS_PATH):
+    header, (indptr, indices, data) = open_ratings(path)
+    ratings = sparse.csr_matrix((data, indices, indptr), shape=(len(header['users']), len(header['dishes'])))
+    return pd.Index(header['users'], name='UserID'), np.array(header['dishes'], dtype=object), ratings
+
+
+#! Function to load the survey ratings, from the binary snapshot when it matches the CSV, else importing the CSV
+def load_ratings():
+    source = csv_signature(SURVEY_PATH)
+    try:
+        header, _ = open_ratings(RATINGS_PATH)
+    except (OSError, ValueError):
+        header = None  #? No snapshot yet, or one in an older layout: import the CSV
+    if header is not None and header['source'] == source:
+        return read_ratings(RATINGS_PATH)
+
+    ratings_df = pd.read_csv(SURVEY_PATH)
+    ratings_df.set_index('UserID', inplace=True)
+    index, columns, ratings = ratings_df.index, ratings_df.columns.values, sparse_ratings(ratings_df.values)
+    export_ratings(index, columns, ratings, RATINGS_PATH, source)
+    return read_ratings(RATINGS_PATH)
+
+
+#! Function to write the store to an open file as the survey CSV (UserID, then one column per dish, empty where there
+#! is no value), a block of users at a time
+def write_survey(f):
+    for start in range(0, max(len(user_index), 1), SURVEY_BLOCK_SIZE):
+        rows = np.arange(start, min(start + SURVEY_BLOCK_SIZE, len(user_index)))
+        block = pd.DataFrame(stored_rows(rows), index=user_index[rows], columns=dish_names)
+        block.to_csv(f, header=start == 0, index_label='UserID')
+
+
+#! The store, loaded by load_state() with the journal replayed over it
+user_index = None
+dish_names = None
+stored_ratings = None
+
+#! Simulate user IDs from the CSV file
+users = {}
+
+
+#! Large catalogues: above DENSE_SIMILARITY_LIMIT dishes the dense (dishes x dishes) similarity is never built. The top
+#! SIMILARITY_TOP_K neighbors of every dish are computed in row blocks instead, across forked workers that share the
+#! ratings matrix with this process copy-on-write, and kept as a sparse matrix: memory grows with dishes x K
+DENSE_SIMILARITY_LIMIT = 4096
+SIMILARITY_TOP_K = 32
+SIMILARITY_BLOCK_SIZE = 256
+SIMILARITY_WORKERS = os.cpu_count() or 1
+SIMILARITY_DTYPE = np.float32
+
+similarity_inputs = None  #? (ratings, norms) while a build runs, read by the workers
+stale_dishes = set()  #? Dishes whose ratings changed since their sparse neighbors were computed
+dish_squares = None  #? Sparse form: the sum of squared observed ratings of every dish, kept up to date cell by cell
+rater_index = None  #? Sparse form: every dish's raters (column offsets and store rows), built on first use
+new_raters = {}  #? Dish -> store rows of the users who rated it since rater_index was built
+
+#! The similarity is built on first use by current_similarity(); until then rating changes only move the ratings and
+#! the priors, which the build reads. dish_dots is None once built means the sparse top-K form
+dish_dots = None
+dish_norms = None
+dish_similarity = None
+content_similarity = None
+neighbor_table = None
+neighbor_scores = None
+neighbor_versions = np.zeros(0, dtype=np.int64)  #? Bumped for every neighbor row that changes
+
+
+#! Function to compute the sum of squares of every dish column of the observed ratings
+def column_squares(ratings):
+    return np.asarray(ratings.multiply(ratings).sum(axis=0)).ravel()
+
+
+#! Function to turn the dot products of a block of dishes with every dish into their full similarity rows
+def cosine_rows(rows, dish_ids, norms):
+    denominator = np.outer(norms[dish_ids], norms)
+    np.divide(rows, denominator, out=rows, where=denominator > 0)
+    return blend_similarity(rows, denominator > 0, content_rows(dish_ids))
+
+
+#! Function to compute the full similarity rows of a block of dishes
+def similarity_rows(dish_ids):
+    ratings, norms = similarity_inputs
+    return cosine_rows((ratings[:, dish_ids].T @ ratings).toarray(), dish_ids, norms)
+
+
+#! Function to find the store rows of the users who rated any of the given dishes, from the per-dish rater index
+def dish_raters(dish_ids):
+    global rater_index
+
+    if rater_index is None:
+        columns = stored_ratings.tocsc()
+        rater_index = (columns.indptr, columns.indices)
+        new_raters.clear()
+    indptr, rows = rater_index
+    parts = [rows[indptr[dish_id]:indptr[dish_id + 1]] for dish_id in dish_ids]
+    parts += [np.array(new_raters[dish_id], dtype=rows.dtype) for dish_id in dish_ids if dish_id in new_raters]
+    return np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+
+
+#! Function to compute the full similarity rows of a few dishes over just the users who rated them, with the maintained
+#! norms: one pass over those users' ratings instead of a column-major copy of all of them
+def rated_similarity_rows(dish_ids):
+    raters = dish_raters(dish_ids)
+    ratings = observed_matrix(raters if len(raters) < stored_ratings.shape[0] else None).astype(SIMILARITY_DTYPE)
+    return cosine_rows((ratings.T @ ratings[:, dish_ids].toarray()).T, dish_ids, dish_norms)
+
+
+#! Function to pick the top-K neighbors (the dish itself included) out of full similarity rows, best first and ties to
+#! the higher id like the dense neighbor table
+def top_neighbors(rows):
+    width = min(SIMILARITY_TOP_K + 1, rows.shape[1])
+    ids = np.argpartition(-rows, width - 1, axis=1)[:, :width]
+    scores = np.take_along_axis(rows, ids, axis=1)
+    order = np.lexsort((-ids, -scores), axis=1)
+    return np.take_along_axis(ids, order, axis=1).astype(np.int32), np.take_along_axis(scores, order, axis=1)
+
+
+#! Function to compute the top-K neighbors of a block of dishes
+def similarity_block(dish_ids):
+    return top_neighbors(similarity_rows(dish_ids))
+
+
+#! Function to compute the neighbor rows of the given dishes block by block, in a process pool when there are several blocks
+def compute_sparse_neighbors(ratings, norms, dish_ids):
+    global similarity_inputs
+
+    blocks = [dish_ids[i:i + SIMILARITY_BLOCK_SIZE] for i in range(0, len(dish_ids), SIMILARITY_BLOCK_SIZE)]
+    similarity_inputs = (ratings, norms)
+    try:
+        if len(blocks) > 1 and SIMILARITY_WORKERS > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            #? Forked workers read similarity_inputs from pages shared with this process; only the ids and results are pickled
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(min(SIMILARITY_WORKERS, len(blocks)), mp_context=context) as pool:
+                results = list(pool.map(similarity_block, blocks))
+        else:
+            results = [similarity_block(block) for block in blocks]
+    finally:
+        similarity_inputs = None
+
+    if not results:
+        width = min(SIMILARITY_TOP_K + 1, len(norms))
+        return np.empty((0, width), dtype=np.int32), np.empty((0, width), dtype=SIMILARITY_DTYPE)
+    return np.concatenate([ids for ids, _ in results]), np.concatenate([scores for _, scores in results])
+
+
+#! Function to wrap the neighbor table in a (dishes x dishes) CSR matrix: row i holds the K+1 entries of neighbor row i
+def neighbor_matrix():
+    num_dishes, width = neighbor_table.shape
+    indptr = np.arange(0, num_dishes * width + 1, width)
+    return sparse.csr_matrix((neighbor_scores.ravel().copy(), neighbor_table.ravel().copy(), indptr),
+                             shape=(num_dishes, num_dishes))
+
+
+#! Function to bring the sparse neighbors up to date after rating changes. Only the similarities of the changed (stale)
+#! dishes moved, and their norms already follow every change, so their full rows are computed over just the users who
+#! rated them. Every other row keeps its unchanged entries and takes the stale dishes' new scores in; it is recomputed
+#! in full only when a stale dish falls out of it and a dish it does not list might take the place
+@timed('similarity_refresh')
+def refresh_stale_neighbors():
+    if not stale_dishes:
+        return
+
+    stale = np.array(sorted(stale_dishes))
+    stale_dishes.clear()
+    num_dishes, width = neighbor_table.shape
+    changed = np.zeros(num_dishes, dtype=bool)
+    broken = np.zeros(num_dishes, dtype=bool)
+
+    for i in range(0, len(stale), SIMILARITY_BLOCK_SIZE):
+        block = stale[i:i + SIMILARITY_BLOCK_SIZE]
+        rows = rated_similarity_rows(block)
+
+        #? A row changes if it lists a stale dish or a stale dish now ranks above its last entry
+        last_ids, last_scores = neighbor_table[:, -1], neighbor_scores[:, -1]
+        enters = (rows > last_scores) | ((rows == last_scores) & (block[:, None] > last_ids))
+        touched = np.isin(neighbor_table, block).any(axis=1) | enters.any(axis=0)
+        touched[block] = False
+        others = np.flatnonzero(touched)
+
+        ids, scores = neighbor_table[others], neighbor_scores[others]
+        listed = np.isin(ids, block)
+        candidate_ids = np.concatenate([np.where(listed, -1, ids), np.broadcast_to(block, (len(others), len(block)))], axis=1)
+        candidate_scores = np.concatenate([np.where(listed, -np.inf, scores), rows[:, others].T], axis=1)
+        order = np.lexsort((-candidate_ids, -candidate_scores), axis=1)[:, :width]
+        new_ids = np.take_along_axis(candidate_ids, order, axis=1)
+        new_scores = np.take_along_axis(candidate_scores, order, axis=1)
+
+        #? Every dish a row does not list ranks below its old last entry, so the new list is exact unless its own last
+        #? entry ranks lower than that
+        broken[others] |= (new_scores[:, -1] < scores[:, -1]) | ((new_scores[:, -1] == scores[:, -1]) &
+                                                                  (new_ids[:, -1] < ids[:, -1]))
+        neighbor_table[others], neighbor_scores[others] = new_ids, new_scores
+        changed[others] |= ((new_ids != ids) | (new_scores != scores)).any(axis=1)
+        neighbor_table[block], neighbor_scores[block] = top_neighbors(rows)
+        changed[block], broken[block] = True, False
+
+    broken = np.flatnonzero(broken)
+    for i in range(0, len(broken), SIMILARITY_BLOCK_SIZE):
+        block = broken[i:i + SIMILARITY_BLOCK_SIZE]
+        neighbor_table[block], neighbor_scores[block] = top_neighbors(rated_similarity_rows(block))
+        changed[block] = True
+
+    rows = np.flatnonzero(changed)
+    cells = (rows[:, None] * width + np.arange(width)).ravel()
+    dish_similarity.indices[cells] = neighbor_table[rows].ravel()
+    dish_similarity.data[cells] = neighbor_scores[rows].ravel()
+    dish_similarity.has_sorted_indices = False
+    neighbor_versions[rows] += 1
+
+
+#! Function to key the cached similarity: the observed ratings, the content features and every setting the build reads
+def similarity_key(observed):
+    return artifact_key(observed.indptr, observed.indices, observed.data, content_ingredients.indptr, content_ingredients.indices, content_ingredients.data,
+                        content_attributes, len(dish_names) > DENSE_SIMILARITY_LIMIT, SIMILARITY_TOP_K,
+                        np.dtype(SIMILARITY_DTYPE).str, CONTENT_WEIGHT, CONTENT_ATTRIBUTE_WEIGHT)
+
+
+#! Function to rebuild dish similarity from scratch over the observed ratings, along with the dot products and norms that
+#! keep it up to date. With cached set the expensive part (dot products and content similarity, or the sparse neighbors)
+#! comes from the artifact cache when it was built over the same inputs, and is saved there otherwise
+@timed('similarity_build')
+def rebuild_similarity(cached=False):
+    global dish_dots, dish_norms, dish_squares, dish_similarity, content_similarity, neighbor_table, neighbor_scores
+    global neighbor_versions, rater_index
+
+    num_dishes = len(dish_names)
+    neighbor_versions = np.zeros(num_dishes, dtype=np.int64)
+    clear_recommendation_cache()
+    stale_dishes.clear()
+    drop_rater_index()
+
+    observed = observed_matrix()
+    key = similarity_key(observed) if cached else None
+    saved = load_artifact('similarity', key)
+
+    if num_dishes > DENSE_SIMILARITY_LIMIT:
+        ratings = observed.astype(SIMILARITY_DTYPE).tocsc()
+        dish_dots, content_similarity = None, None
+        dish_squares = column_squares(observed)
+        dish_norms = np.sqrt(dish_squares)
+        rater_index = (ratings.indptr, ratings.indices)
+        if saved is not None:
+            neighbor_table, neighbor_scores = saved['neighbor_table'], saved['neighbor_scores']
+        else:
+            neighbor_table, neighbor_scores = compute_sparse_neighbors(ratings, dish_norms, np.arange(num_dishes))
+            if cached:
+                save_artifact('similarity', key, {'neighbor_table': neighbor_table, 'neighbor_scores': neighbor_scores})
+        dish_similarity = neighbor_matrix()
+        return dish_similarity
+
+    if saved is not None:
+        dish_dots, content_similarity = saved['dish_dots'], saved['content_similarity']
+    else:
+        if observed.nnz > observed.shape[0] * observed.shape[1] // 2:
+            #? Mostly filled in, like the survey: a dense product, BLAS is far faster than a sparse one there
+            observed = observed.toarray()
+            dish_dots = observed.T @ observed
+        else:
+            dish_dots = (observed.T @ observed).toarray()
+        content_similarity = content_rows(np.arange(num_dishes))
+        if cached:
+            save_artifact('similarity', key, {'dish_dots': dish_dots, 'content_similarity': content_similarity})
+    dish_norms = np.sqrt(np.diag(dish_dots))
+    dish_similarity = np.empty_like(dish_dots)
+    similarity_from_dots()
+    return dish_similarity
+
+
+#! Function to get the dish similarity ready to read: built on first use (from the artifact cache when it was built over
+#! the same inputs), with the sparse neighbors of changed dishes caught up and the dense neighbor table in place. The
+#! work happens under the state writer, so readers never change the similarity themselves
+def current_similarity():
+    if dish_similarity is None or stale_dishes or neighbor_table is None:
+        with state_writer():
+            if dish_similarity is None:
+                rebuild_similarity(cached=True)
+            refresh_stale_neighbors()
+            if neighbor_table is None:
+                build_neighbor_table()
+    return dish_similarity
+
+
+#! Function to throw the similarity away after the ratings were reloaded; current_similarity() builds it again
+def drop_similarity():
+    global dish_dots, dish_norms, dish_squares, dish_similarity, content_similarity, neighbor_table, neighbor_scores
+
+    dish_dots = dish_norms = dish_squares = dish_similarity = content_similarity = neighbor_table = neighbor_scores = None
+    stale_dishes.clear()
+    drop_rater_index()
+    clear_recommendation_cache()
+
+
+#! Function to throw the rater index away; dish_raters() builds it again from the store
+def drop_rater_index():
+    global rater_index
+
+    rater_index = None
+    new_raters.clear()
+
+
+#! Function to widen the built similarity to dishes just added to the store. Nobody has rated them, so their dot
+#! products and norms are 0 and their similarity is the content similarity alone: the dense form is recomputed from the
+#! padded dot products, the sparse form gets their neighbor rows computed as stale dishes on next read
+def grow_similarity():
+    global dish_dots, dish_norms, dish_squares, dish_similarity, content_similarity, neighbor_table, neighbor_scores
+    global neighbor_versions
+
+    if dish_similarity is None:
+        return
+    num_old, num_dishes = len(dish_norms), len(dish_names)
+    sparse_form = dish_dots is None
+    if sparse_form != (num_dishes > DENSE_SIMILARITY_LIMIT) or (sparse_form and
+                                                               neighbor_table.shape[1] < min(SIMILARITY_TOP_K + 1, num_dishes)):
+        drop_similarity()  #? The new dishes change the form or the width of the neighbor rows: built again on next use
+        return
+
+    added = np.arange(num_old, num_dishes)
+    neighbor_versions = np.concatenate([neighbor_versions, np.zeros(len(added), dtype=neighbor_versions.dtype)])
+    dish_norms = np.concatenate([dish_norms, np.zeros(len(added), dtype=dish_norms.dtype)])
+    build_content_features()
+    clear_recommendation_cache()
+
+    if sparse_form:
+        dish_squares = np.concatenate([dish_squares, np.zeros(len(added), dtype=dish_squares.dtype)])
+        width = neighbor_table.shape[1]
+        neighbor_table = np.vstack([neighbor_table, np.repeat(added[:, None], width, axis=1).astype(neighbor_table.dtype)])
+        neighbor_scores = np.vstack([neighbor_scores, np.full((len(added), width), -np.inf, dtype=neighbor_scores.dtype)])
+        drop_rater_index()  #? Its column offsets end at the old last dish
+        stale_dishes.update(added.tolist())
+        dish_similarity = neighbor_matrix()
+        return
+
+    dots = np.zeros((num_dishes, num_dishes), dtype=dish_dots.dtype)
+    dots[:num_old, :num_old] = dish_dots
+    dish_dots = dots
+    dish_similarity = np.empty_like(dish_dots)
+    content_similarity = content_rows(np.arange(num_dishes))
+    similarity_from_dots()
+
+
+#! Function to fold a batch of new or replaced user rows (observed ratings, 0 elsewhere) into the similarity as one
+#! rank-k update of the dot products, O(batch x dishes^2) instead of a recompute over every user
+def add_similarity_rows(old_rows, new_rows):
+    if dish_similarity is None:
+        return  #? Not built yet: the build reads the current ratings
+    if dish_dots is None:
+        dish_squares[:] += (new_rows ** 2).sum(axis=0) - (old_rows ** 2).sum(axis=0)
+        dish_norms[:] = np.sqrt(np.maximum(dish_squares, 0))
+        stale_dishes.update(np.flatnonzero((old_rows != new_rows).any(axis=0)).tolist())
+        if ((old_rows == 0) & (new_rows != 0)).any():
+            drop_rater_index()  #? A batch's new raters are picked up by rebuilding the index
+        return
+
+    dish_dots[:] += new_rows.T @ new_rows - old_rows.T @ old_rows
+    dish_norms[:] = np.sqrt(np.maximum(np.diag(dish_dots), 0))
+    similarity_from_dots()
+
+
+#! Function to recompute the whole dense similarity from the maintained dot products and the content similarity
+def similarity_from_dots():
+    global neighbor_table, neighbor_scores
+
+    denominator = np.outer(dish_norms, dish_norms)
+    collaborative = np.divide(dish_dots, denominator, out=np.zeros_like(dish_dots), where=denominator > 0)
+    dish_similarity[:] = blend_similarity(collaborative, denominator > 0, content_similarity)
+    neighbor_table, neighbor_scores = None, None
+    neighbor_versions[:] += 1
+
+
+#! Function to change several ratings of one user (distinct dishes) at once, O(dishes) per changed dish. The dot products
+#! move cell by cell, but the ratings are written in one go and the similarity rows and neighbor table are refreshed
+#! once for all the changed dishes
+def set_ratings(user_id, dish_ids, new_ratings):
+    row = observed_row(user_id)
+    old_ratings = observed_ratings([user_id])[0][dish_ids]
+    position = user_index.get_loc(user_id)
+    store_cells(position, dish_ids, new_ratings)
+
+    invalidate_user(user_id)
+
+    changed = []
+    for dish_id, old_rating, new_rating in zip(dish_ids, old_ratings, new_ratings):
+        #? A cell the user had not rated counts as 0 in the dot products and not at all in the priors
+        old_rating = old_rating if np.isfinite(old_rating) else None
+        if old_rating != new_rating:
+            update_prior_cell(user_id, dish_id, old_rating, new_rating)
+
+        delta = new_rating - row[dish_id]
+        if delta == 0:
+            continue
+
+        if dish_dots is not None:
+            dish_dots[dish_id, :] += delta * row
+            dish_dots[:, dish_id] += delta * row
+            dish_dots[dish_id, dish_id] += delta * delta
+            changed.append(dish_id)
+        elif dish_similarity is not None:
+            dish_squares[dish_id] += new_rating * new_rating - row[dish_id] * row[dish_id]
+            dish_norms[dish_id] = np.sqrt(max(dish_squares[dish_id], 0))
+            stale_dishes.add(dish_id)
+            if old_rating is None and rater_index is not None:
+                new_raters.setdefault(dish_id, []).append(position)
+        row[dish_id] = new_rating
+
+    if not changed:
+        return
+
+    dish_norms[changed] = np.sqrt(dish_dots[changed, changed])
+    denominator = dish_norms[changed, None] * dish_norms
+    rows = np.divide(dish_dots[changed], denominator, out=np.zeros_like(denominator), where=denominator > 0)
+    rows = blend_similarity(rows, denominator > 0, content_similarity[changed])
+    #? In order, so the entry between two changed dishes comes from the later one, as with one change after another
+    for dish_id, similarity_row in zip(changed, rows):
+        dish_similarity[dish_id, :] = similarity_row
+        dish_similarity[:, dish_id] = similarity_row
+    refresh_neighbors(changed)
+
+
+#! Recommendations are cached per (user, pantry bitmask, meal time mask, count, engine) in an LRU with a TTL.
+#! An entry goes stale once its user's version moves (their ratings or recently selected dishes changed), once the
+#! cold-start prior their unrated dishes read as changes or, for a result that went through the similarity retry,
+#! once a neighbor row of its candidate dishes is refreshed
+RECOMMENDATION_CACHE_SIZE = 1024
+RECOMMENDATION_CACHE_TTL = 300  #? Seconds
+
+recommendation_cache = OrderedDict()
+recommendation_cache_lock = threading.Lock()
+recommendation_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidated': 0}
+user_versions = {}
+
+
+#! Function to mark every cached recommendation of a user as stale; called under the state writer, so readers
+#! see the bump together with the change
+def invalidate_user(user_id):
+    user_versions[user_id] = user_versions.get(user_id, 0) + 1
+
+
+#! Function to get the version a user's cached results are checked against: their own version and, unless they rated
+#! every dish, the version of the cold-start prior the rest read as
+def rating_version(user_id):
+    if fully_rated(user_id):
+        return user_versions.get(user_id, 0), None
+    return user_versions.get(user_id, 0), cold_start_prior(*user_segments.get(user_id, (None, None)))[1]
+
+
+#! Function to drop every cached recommendation
+def clear_recommendation_cache():
+    with recommendation_cache_lock:
+        recommendation_cache.clear()
+
+
+#! Function to look up the (path, result) of a live cache entry; expired and stale entries are dropped on the way.
+#! A retry result is only checked against neighbor rows that are current, so it counts as stale while any are pending
+def cached_recommendations(key):
+    current = rating_version(key[0]) if key[0] in user_index else None
+    with recommendation_cache_lock:
+        entry = recommendation_cache.get(key)
+        if entry is None:
+            recommendation_cache_stats['misses'] += 1
+            return None
+
+        expires, version, dish_ids, dish_versions, path, result = entry
+        if time.monotonic() > expires:
+            recommendation_cache_stats['expired'] += 1
+        elif version != current or (dish_ids is not None and (
+                stale_dishes or (neighbor_versions[dish_ids] != dish_versions).any())):
+            recommendation_cache_stats['invalidated'] += 1
+        else:
+            recommendation_cache.move_to_end(key)
+            recommendation_cache_stats['hits'] += 1
+            return path, result
+
+        del recommendation_cache[key]
+        recommendation_cache_stats['misses'] += 1
+        return None
+
+
+#! Function to store a result computed from what was read before computing it: the state_version, the user's
+#! rating_version and, for a path that read neighbors (dish_ids), their neighbor_versions. A write that raced the
+#! computation leaves nothing cached, so an entry never holds versions newer than the state its result came from
+def cache_recommendations(key, state, version, path, result, dish_ids=None, dish_versions=None):
+    if state % 2 or state_version != state or (dish_ids is not None and dish_versions is None):
+        return
+    with recommendation_cache_lock:
+        recommendation_cache[key] = (time.monotonic() + RECOMMENDATION_CACHE_TTL, version, dish_ids, dish_versions, path, result)
+        recommendation_cache.move_to_end(key)
+        while len(recommendation_cache) > RECOMMENDATION_CACHE_SIZE:
+            recommendation_cache.popitem(last=False)
+            recommendation_cache_stats['evictions'] += 1
+
+
+INVENTORY_PATH = "temp_dish_inventory.csv"
+DISH_ATTRIBUTES = ['Oiliness', 'Cooking Time', 'Preparation Time', 'Spiciness']  #? Numeric columns, used when the inventory has them
+
+ITEM_ID_BASE = 1  #? Item_ids number the survey's dish columns from 1: Item_id 1 is dish 0
+
+#! The inventory and everything built from it, loaded by load_inventory(). dish_inventory_rows maps every dish id to
+#! its inventory row, -1 for a dish the inventory does not list
+inventory_df = None
+ingredient_columns = attribute_columns = meal_time_columns = None
+ingredient_bits = {}
+dish_ingredient_masks = dish_in_inventory = dish_inventory_rows = substitute_masks = meal_time_masks = None
+
+
+#! Function to normalize a CSV column name: surrounding and repeated whitespace removed ('Carrots ', 'Rava ')
+def normalize_column(name):
+    return " ".join(str(name).split())
+
+
+#! Function to get the dish ids (survey columns) of inventory Item_ids
+def item_dish_ids(item_ids):
+    return np.asarray(item_ids, dtype=np.int64) - ITEM_ID_BASE
+
+
+#! Function to map every dish id (at least num_dishes of them) to its inventory row, -1 where the inventory lists none;
+#! the first row of an Item_id wins
+def build_dish_rows(inventory_df, num_dishes):
+    dish_ids = item_dish_ids(inventory_df['Item_id'])
+    dish_rows = np.full(max(num_dishes, dish_ids.max(initial=-1) + 1), -1, dtype=np.int64)
+    listed, first_rows = np.unique(dish_ids, return_index=True)
+    dish_rows[listed[listed >= 0]] = first_rows[listed >= 0]
+    return dish_rows
+
+
+#! Function to pack each dish's ingredients into uint64 bitmasks, indexed by dish id; also returns which dishes the
+#! inventory lists and the dish id -> inventory row map
+def build_ingredient_index(inventory_df, ingredient_columns, num_dishes):
+    num_words = max(1, (len(ingredient_columns) + 63) // 64)
+    has_ingredient = inventory_df[ingredient_columns].values == 1
+
+    row_masks = np.zeros((len(inventory_df), num_words), dtype=np.uint64)
+    for j in range(len(ingredient_columns)):
+        row_masks[has_ingredient[:, j], j // 64] |= np.uint64(1) << np.uint64(j % 64)
+
+    dish_rows = build_dish_rows(inventory_df, num_dishes)
+    dish_in_inventory = dish_rows >= 0
+    dish_masks = np.zeros((len(dish_rows), num_words), dtype=np.uint64)
+    dish_masks[dish_in_inventory] = row_masks[dish_rows[dish_in_inventory]]
+    return dish_masks, dish_in_inventory, dish_rows
+
+
+#! Function to pack a list of ingredient names into a pantry bitmask
+def build_pantry_mask(available_ingredients):
+    pantry = np.zeros(dish_ingredient_masks.shape[1], dtype=np.uint64)
+    for ingredient in set(available_ingredients):
+        if ingredient in ingredient_bits:
+            j = ingredient_bits[ingredient]
+            pantry[j // 64] |= np.uint64(1) << np.uint64(j % 64)
+    return pantry
+
+
+#! Function to find every dish (or every dish in dish_ids) that can be cooked from the pantry in a single subset check
+def cookable_dishes(pantry_mask, dish_ids=None):
+    if dish_ids is None:
+        dish_ids = slice(None)
+    missing = (dish_ingredient_masks[dish_ids] & ~pantry_mask).any(axis=1)
+    return dish_in_inventory[dish_ids] & ~missing
+
+
+#! Substitution graph: ingredient -> pantry ingredients that can stand in for it. A dish that is not fully cookable can
+#! still be offered when, after substitutes, it is missing at most MAX_MISSING_INGREDIENTS ingredients
+INGREDIENT_SUBSTITUTES = {
+    'Chole': ['Chickpeas'],
+    'Chickpeas': ['Chole'],
+    'Rajma': ['Chole', 'Chickpeas'],
+    'Lentils': ['Urad Dal'],
+    'Urad Dal': ['Lentils'],
+    'Spinach': ['Fenugreek leaves'],
+    'Fenugreek leaves': ['Spinach'],
+    'Lauki': ['Tinda', 'Pumpkin'],
+    'Tinda': ['Lauki'],
+    'Pumpkin': ['Lauki'],
+    'Cabbage': ['Cauliflower'],
+    'Cauliflower': ['Cabbage'],
+    'Beans': ['Peas'],
+    'Peas': ['Beans'],
+    'Rava': ['Poha'],
+    'Poha': ['Rava'],
+    'Sev': ['Peanuts'],
+}
+MAX_MISSING_INGREDIENTS = 1
+
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+#! Function to count the set bits of each row of a uint64 bitmask array
+def popcount(words):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    as_bytes = np.ascontiguousarray(words, dtype='<u8').view(np.uint8)
+    return POPCOUNT_TABLE[as_bytes].reshape(*words.shape[:-1], -1).sum(axis=-1, dtype=np.int64)
+
+
+#! Function to list the ingredient ids whose bits are set in a bitmask
+def mask_ingredients(mask):
+    bits = np.unpackbits(np.ascontiguousarray(mask, dtype='<u8').view(np.uint8), bitorder='little')
+    return np.flatnonzero(bits[:len(ingredient_columns)])
+
+
+#! Function to build one bitmask per ingredient holding the ingredient itself and everything that can stand in for it
+def build_substitute_masks(substitutes):
+    return np.array([
+        build_pantry_mask([ingredient] + substitutes.get(ingredient, []))
+        for ingredient in ingredient_columns
+    ]).reshape(len(ingredient_columns), dish_ingredient_masks.shape[1])
+
+
+#! Function to get the bitmask of every ingredient the pantry covers, directly or through a substitute
+def covered_ingredients(pantry_mask):
+    covered = (substitute_masks & pantry_mask).any(axis=1)
+    bits = np.zeros(dish_ingredient_masks.shape[1] * 64, dtype=bool)
+    bits[:len(covered)] = covered
+    return np.packbits(bits, bitorder='little').view('<u8').astype(np.uint64)
+
+
+#! Function to count, for every dish (or every dish in dish_ids), the ingredients still missing once substitutes are used
+#! and the ingredients that need a substitute, with vectorized popcounts over the dish bitmasks
+def match_ingredients(pantry_mask, dish_ids=None):
+    if dish_ids is None:
+        dish_ids = slice(None)
+    needed = dish_ingredient_masks[dish_ids]
+    covered = covered_ingredients(pantry_mask)
+    return popcount(needed & ~covered), popcount(needed & covered & ~pantry_mask)
+
+
+#! Function to pick the best n candidates that are missing at most MAX_MISSING_INGREDIENTS ingredients after substitutes,
+#! fewest missing first, then fewest substitutes, then by score
+def partial_matches(scores, candidates, pantry_mask, n):
+    candidate_ids = np.flatnonzero(candidates & dish_in_inventory[:len(candidates)])
+    missing, substituted = match_ingredients(pantry_mask, candidate_ids)
+    keep = missing <= MAX_MISSING_INGREDIENTS
+    ids = candidate_ids[keep]
+    order = np.lexsort((ids, -scores[ids], substituted[keep], missing[keep]))
+    return ids[order[:n]]
+
+
+#! Function to work out what a dish still needs from the pantry: the missing ingredients and the substitutes to use
+def missing_ingredients(dish_id, pantry_mask):
+    missing, substitutions = [], {}
+    if not 0 <= dish_id < len(dish_in_inventory) or not dish_in_inventory[dish_id]:
+        return missing, substitutions
+
+    for j in mask_ingredients(dish_ingredient_masks[dish_id] & ~pantry_mask):
+        available = mask_ingredients(substitute_masks[j] & pantry_mask)
+        if len(available):
+            substitutions[ingredient_columns[j]] = ingredient_columns[available[0]]
+        else:
+            missing.append(ingredient_columns[j])
+    return missing, substitutions
+
+
+#! Function to describe a partial match for display ('use X for Y; missing Z'), empty when the dish is fully cookable
+def describe_match(dish_id, pantry_mask):
+    missing, substitutions = missing_ingredients(dish_id, pantry_mask)
+    parts = [f"use {alt} for {ingredient}" for ingredient, alt in substitutions.items()]
+    if missing:
+        parts.append("missing " + ", ".join(missing))
+    return "; ".join(parts)
+
+
+#! Function to build the meal-time masks: Breakfast/Lunch/Dinner/Snacks -> boolean array over dish ids, read through
+#! the same dish id -> inventory row map as the ingredient index
+def build_meal_time_masks():
+    listed = dish_inventory_rows >= 0
+    masks = {}
+    for meal_time in meal_time_columns:
+        masks[meal_time] = np.zeros(len(dish_inventory_rows), dtype=bool)
+        masks[meal_time][listed] = inventory_df[meal_time].values[dish_inventory_rows[listed]] == 1
+    return masks
+
+
+
+#! Content similarity: dishes are also compared on what they are made of (Jaccard over the ingredients) and on their
+#! attributes (cosine over the meal times they are served at plus any DISH_ATTRIBUTES columns). It is blended with the
+#! collaborative similarity by CONTENT_WEIGHT, and stands in alone for a dish nobody has rated yet, so a new dish has
+#! neighbors right away
+CONTENT_WEIGHT = 0.0
+CONTENT_ATTRIBUTE_WEIGHT = 0.3
+
+
+#! Function to collect the content features of every dish id, attributes scaled to [0, 1]; dishes missing from the inventory get zeros
+def build_content_features():
+    global content_ingredients, content_ingredient_counts, content_attributes, content_attribute_norms, content_attribute_scale
+
+    num_dishes = len(dish_names)
+    dish_rows = dish_inventory_rows[:num_dishes]
+    dish_ids = np.flatnonzero(dish_rows >= 0)
+    rows = inventory_df.iloc[dish_rows[dish_ids]]
+
+    has_ingredient = np.zeros((num_dishes, len(ingredient_columns)), dtype=SIMILARITY_DTYPE)
+    has_ingredient[dish_ids] = rows[ingredient_columns].values == 1
+    content_ingredients = sparse.csr_matrix(has_ingredient)
+    content_ingredient_counts = has_ingredient.sum(axis=1)
+
+    attributes = rows[meal_time_columns + attribute_columns].values.astype(float)
+    content_attribute_scale = np.abs(attributes).max(axis=0, initial=0)
+    content_attributes = np.zeros((num_dishes, attributes.shape[1]), dtype=SIMILARITY_DTYPE)
+    content_attributes[dish_ids] = np.divide(attributes, content_attribute_scale, out=np.zeros_like(attributes),
+                                             where=content_attribute_scale > 0)
+    content_attribute_norms = np.linalg.norm(content_attributes, axis=1)
+
+
+#! Function to compute the content similarity rows of a block of dishes
+def content_rows(dish_ids):
+    shared = (content_ingredients[dish_ids] @ content_ingredients.T).toarray()
+    union = content_ingredient_counts[dish_ids, None] + content_ingredient_counts[None, :] - shared
+    jaccard = np.divide(shared, union, out=np.zeros_like(shared), where=union > 0)
+    dots = content_attributes[dish_ids] @ content_attributes.T
+    denominator = np.outer(content_attribute_norms[dish_ids], content_attribute_norms)
+    cosine = np.divide(dots, denominator, out=np.zeros_like(dots), where=denominator > 0)
+    return (1 - CONTENT_ATTRIBUTE_WEIGHT) * jaccard + CONTENT_ATTRIBUTE_WEIGHT * cosine
+
+
+#! Function to blend collaborative and content similarity; rated marks the pairs where both dishes have observed ratings
+def blend_similarity(collaborative, rated, content):
+    return np.where(rated, (1 - CONTENT_WEIGHT) * collaborative + CONTENT_WEIGHT * content, content)
+
+
+#! Function to follow an inventory change in the content similarity; dish_ids are the dishes whose rows changed
+def refresh_content_similarity(dish_ids):
+    global content_similarity
+
+    scale = content_attribute_scale
+    build_content_features()
+    if dish_similarity is None:
+        return
+    if dish_dots is None:
+        #? Rescaled attributes move every pair, otherwise only the changed dishes' pairs moved
+        rescaled = len(scale) != len(content_attribute_scale) or (scale != content_attribute_scale).any()
+        stale_dishes.update(range(len(dish_names)) if rescaled else dish_ids)
+        return
+
+    content_similarity = content_rows(np.arange(len(dish_names)))
+    similarity_from_dots()
+
+
+#! Function to load the inventory and everything built from it: the column groups, the ingredient index, the substitute
+#! and meal-time masks and the content features
+def load_inventory():
+    global inventory_df, ingredient_columns, attribute_columns, meal_time_columns, ingredient_bits, dish_ingredient_masks, \
+        dish_in_inventory, dish_inventory_rows, substitute_masks, meal_time_masks
+
+    inventory_df = pd.read_csv(INVENTORY_PATH).rename(columns=normalize_column)
+    ingredient_columns = [column for column in inventory_df.columns[2:-4] if column not in DISH_ATTRIBUTES]
+    attribute_columns = [column for column in inventory_df.columns[2:-4] if column in DISH_ATTRIBUTES]
+    meal_time_columns = inventory_df.columns[-4:].tolist()
+
+    ingredient_bits = {ingredient: j for j, ingredient in enumerate(ingredient_columns)}
+    dish_ingredient_masks, dish_in_inventory, dish_inventory_rows = build_ingredient_index(inventory_df, ingredient_columns,
+                                                                                          len(dish_names))
+    substitute_masks = build_substitute_masks(INGREDIENT_SUBSTITUTES)
+    meal_time_masks = build_meal_time_masks()
+    build_content_features()
+
+#! Nearest neighbors kept per dish in the dense neighbor table
+NEIGHBORHOOD_SIZE = 5
+
+
+#! Function to give the inventory dishes past the last survey column a rating column each. The columns run up to the
+#! highest dish id the inventory lists (see dish_inventory_rows), each named after its inventory row, 'Dish <id>' for a
+#! gap, with the id appended when the name is taken. Nobody has rated them yet: the store only widens, the priors get
+#! empty columns, the similarity grows to their content neighbors and the factors are trained again on next use
+def add_dishes():
+    global dish_names, stored_ratings, prior_sums, prior_counts, prior_hist, dish_factors
+
+    num_dishes = len(dish_names)
+    listed = np.flatnonzero(dish_inventory_rows >= 0)
+    if not len(listed) or listed[-1] < num_dishes:
+        return 0
+
+    taken = set(dish_names)
+    added = []
+    for dish_id in range(num_dishes, listed[-1] + 1):
+        row = dish_inventory_rows[dish_id]
+        name = str(inventory_df['Items'].iat[row]) if row >= 0 else f"Dish {dish_id}"
+        if name in taken:
+            name = f"{name} ({dish_id})"
+        taken.add(name)
+        added.append(name)
+
+    matrix = stored_ratings
+    stored_ratings = sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr),
+                                       shape=(matrix.shape[0], num_dishes + len(added)))
+    dish_names = np.concatenate([dish_names, np.array(added, dtype=object)])
+    with prior_lock:
+        prior_sums = np.concatenate([prior_sums, np.zeros(len(added))])
+        prior_counts = np.concatenate([prior_counts, np.zeros(len(added), dtype=prior_counts.dtype)])
+        prior_hist = np.vstack([prior_hist, np.zeros((len(added), RATING_BINS), dtype=prior_hist.dtype)])
+        segment_priors.clear()
+        prior_cache.clear()
+    grow_similarity()
+    dish_factors = None
+    return len(added)
+
+
+#! Function to merge inventory rows (Items, Item_id, ingredient, attribute and meal time columns, names normalized) into the inventory
+#! and the ingredient index. Unknown ingredients become new columns; a row for a known Item_id replaces it, and an Item_id
+#! past the last survey column adds rating columns (see add_dishes). Returns the dishes added
+def merge_inventory(rows):
+    global inventory_df, ingredient_columns, attribute_columns, dish_ingredient_masks, dish_in_inventory, dish_inventory_rows, \
+        substitute_masks, meal_time_masks
+
+    fixed = ['Items', 'Item_id'] + meal_time_columns + DISH_ATTRIBUTES
+    new_ingredients = [column for column in rows.columns if column not in fixed and column not in ingredient_bits]
+    ingredient_columns = ingredient_columns + new_ingredients
+    ingredient_bits.update({ingredient: j for j, ingredient in enumerate(ingredient_columns)})
+    attribute_columns = attribute_columns + [column for column in DISH_ATTRIBUTES
+                                             if column in rows.columns and column not in attribute_columns]
+
+    columns = ['Items', 'Item_id'] + ingredient_columns + attribute_columns + meal_time_columns
+    rows = rows.reindex(columns=columns, fill_value=0)
+    kept = inventory_df[~inventory_df['Item_id'].isin(rows['Item_id'])].reindex(columns=columns, fill_value=0)
+    inventory_df = pd.concat([kept, rows], ignore_index=True)
+
+    #? Widen the existing masks if the new ingredients need another word, then drop in the merged rows
+    row_masks, row_in_inventory, _ = build_ingredient_index(rows, ingredient_columns, 0)
+    num_ids = max(len(dish_in_inventory), len(row_in_inventory))
+    masks = np.zeros((num_ids, row_masks.shape[1]), dtype=np.uint64)
+    masks[:len(dish_ingredient_masks), :dish_ingredient_masks.shape[1]] = dish_ingredient_masks
+    masks[:len(row_masks)][row_in_inventory] = row_masks[row_in_inventory]
+    present = np.zeros(num_ids, dtype=bool)
+    present[:len(dish_in_inventory)] = dish_in_inventory
+    present[:len(row_in_inventory)] |= row_in_inventory
+
+    dish_ingredient_masks, dish_in_inventory = masks, present
+    dish_inventory_rows = build_dish_rows(inventory_df, num_ids)
+    substitute_masks = build_substitute_masks(INGREDIENT_SUBSTITUTES)
+    meal_time_masks = build_meal_time_masks()
+    added = add_dishes()
+    dish_ids = item_dish_ids(rows['Item_id'])
+    refresh_content_similarity(dish_ids[(dish_ids >= 0) & (dish_ids < len(dish_names))].tolist())
+    clear_recommendation_cache()
+    return added
+
+
+#! Function to write the inventory back
+def save_inventory():
+    with atomic_write(INVENTORY_PATH, newline='') as f:
+        inventory_df.to_csv(f, index=False)
+
+
+#! Function to turn a meal time name, several names (any of them) or an existing boolean mask into a dish mask; None means no filter
+def build_meal_time_mask(meal_time):
+    if meal_time is None or isinstance(meal_time, np.ndarray):
+        return meal_time
+    names = [meal_time] if isinstance(meal_time, str) else list(meal_time)
+    known = [meal_time_masks[name] for name in names if name in meal_time_masks]
+    return np.logical_or.reduce(known) if known else None
+
+#! Recently selected dishes: one (users x RECENT_HISTORY) int32 ring buffer whose rows follow user_index, -1 in an
+#! empty slot, with the time each slot was written and the next slot to write for every user. Excluding them is a
+#! single mask operation. With RECENT_DECAY set (a half-life in seconds) recent dishes are scored down by
+#! RECENT_PENALTY instead, halving every RECENT_DECAY seconds since they were picked. The history is saved with
+#! every snapshot and selections go through the journal, so it survives restarts and reaches every process
+RECENT_PATH = "Food survey.recent.npz"
+RECENT_HISTORY = 3
+RECENT_DECAY = None
+RECENT_PENALTY = 1.0
+
+
+#! Function to make the history cover num_rows users, growing the capacity geometrically
+def grow_recent(num_rows):
+    global recent_dishes, recent_times, recent_heads
+
+    capacity = len(recent_heads)
+    if num_rows <= capacity:
+        return
+    capacity = max(num_rows, 2 * capacity)
+    grown_dishes = np.full((capacity, RECENT_HISTORY), -1, dtype=np.int32)
+    grown_times = np.zeros((capacity, RECENT_HISTORY))
+    grown_heads = np.zeros(capacity, dtype=np.int32)
+    grown_dishes[:len(recent_heads)] = recent_dishes
+    grown_times[:len(recent_heads)] = recent_times
+    grown_heads[:len(recent_heads)] = recent_heads
+    recent_dishes, recent_times, recent_heads = grown_dishes, grown_times, grown_heads
+
+
+#! Function to record a selection in the user's ring buffer, overwriting the oldest one once the window is full
+def remember_selection(user_id, dish_id, when=None):
+    row = user_index.get_loc(user_id)
+    grow_recent(row + 1)
+    slot = recent_heads[row]
+    recent_dishes[row, slot] = dish_id
+    recent_times[row, slot] = time.time() if when is None else when
+    recent_heads[row] = (slot + 1) % RECENT_HISTORY
+
+
+#! Function to list a user's recent selections, oldest first
+def recent_selections(user_id):
+    row = user_index.get_loc(user_id) if user_id in user_index else len(recent_heads)
+    if row >= len(recent_heads):
+        return []
+    slots = (recent_heads[row] + np.arange(RECENT_HISTORY)) % RECENT_HISTORY
+    return [int(i) for i in recent_dishes[row, slots] if i >= 0]
+
+
+#! Function to get the users' recent dish ids (users x RECENT_HISTORY, -1 where empty) and the times they were picked
+def recent_entries(user_ids):
+    rows = user_index.get_indexer(user_ids)
+    known = (rows >= 0) & (rows < len(recent_heads))
+    rows = np.where(known, rows, 0)
+    return np.where(known[:, None], recent_dishes[rows], -1), np.where(known[:, None], recent_times[rows], 0)
+
+
+#! Function to build the (users x dishes) mask of recent selections to exclude; empty when RECENT_DECAY scores them down instead
+def recent_masks(user_ids, num_dishes):
+    mask = np.zeros((len(user_ids), num_dishes), dtype=bool)
+    if RECENT_DECAY is None:
+        ids, _ = recent_entries(user_ids)
+        users, slots = np.nonzero((ids >= 0) & (ids < num_dishes))
+        mask[users, ids[users, slots]] = True
+    return mask
+
+
+#! Function to build a boolean mask of the dishes a user has selected recently
+def recent_mask(user_id, num_dishes):
+    return recent_masks([user_id], num_dishes)[0]
+
+
+#! Function to get the (users x dishes) score penalty of recent selections, decayed by their age; zero without RECENT_DECAY
+def recent_penalties(user_ids, num_dishes, now=None):
+    penalty = np.zeros((len(user_ids), num_dishes))
+    if RECENT_DECAY is not None:
+        ids, times = recent_entries(user_ids)
+        users, slots = np.nonzero((ids >= 0) & (ids < num_dishes))
+        ages = (time.time() if now is None else now) - times[users, slots]
+        np.maximum.at(penalty, (users, ids[users, slots]), RECENT_PENALTY * 0.5 ** (ages / RECENT_DECAY))
+    return penalty
+
+
+#! Function to write the history of every user with one
+def save_recent():
+    rows = np.flatnonzero((recent_dishes[:len(user_index)] >= 0).any(axis=1))
+    with atomic_write(RECENT_PATH, 'wb') as f:
+        np.savez(f, users=np.asarray(user_index[rows]), dishes=recent_dishes[rows], times=recent_times[rows],
+                 heads=recent_heads[rows])
+
+
+#! Function to load the saved history, then replay the selections journaled since. A saved window of another
+#! width keeps its newest entries
+def restore_recent():
+    global recent_dishes, recent_times, recent_heads
+
+    recent_dishes = np.full((0, RECENT_HISTORY), -1, dtype=np.int32)
+    recent_times = np.zeros((0, RECENT_HISTORY))
+    recent_heads = np.zeros(0, dtype=np.int32)
+    grow_recent(max(len(user_index), 1))
+
+    if os.path.exists(RECENT_PATH):
+        with np.load(RECENT_PATH) as saved:
+            rows = user_index.get_indexer(saved['users'])
+            width = saved['dishes'].shape[1]
+            slots = (saved['heads'][:, None] + np.arange(width)) % width  #? Oldest first
+            ids = np.take_along_axis(saved['dishes'], slots, axis=1)[:, -RECENT_HISTORY:]
+            times = np.take_along_axis(saved['times'], slots, axis=1)[:, -RECENT_HISTORY:]
+            known = rows >= 0
+            recent_dishes[rows[known], RECENT_HISTORY - ids.shape[1]:] = ids[known]
+            recent_times[rows[known], RECENT_HISTORY - ids.shape[1]:] = times[known]
+
+    #? A selection the saved history already holds (a crash between saving it and emptying the journal) is skipped;
+    #? selections journaled together share a timestamp, so only the saved times are compared
+    saved_times = recent_times.max(axis=1)
+    dish_ids = {dish: i for i, dish in enumerate(dish_names)}
+    for when, user_id, dish in journal_selections:
+        if user_id in user_index and dish in dish_ids:
+            row = user_index.get_loc(user_id)
+            if when > saved_times[row] + 0.001:
+                remember_selection(user_id, dish_ids[dish], when)
+
+
+#! Cold start: a new user gets a population prior instead of a fitted model. Per-dish rating sums,
+#! counts and tenth-of-a-star histograms follow every rating change, and so do the aggregates of the
+#! segments asked for lately; each prior is computed once per change, so reading one is a vector copy
+PRIORS_PATH = "Food survey.priors.npz"
+COLD_START = 'mean'
+RATING_BINS = 51  #? 0.0 to 5.0 in steps of 0.1
+SEGMENT_CACHE_SIZE = 64  #? Segments kept up to date, least recently used dropped first
+
+prior_lock = threading.Lock()  #? Readers fill the caches below while the writer moves them
+prior_cache = {}  #? (strategy, segment key) -> (cold-start ratings, version), emptied by every rating change
+prior_versions = OrderedDict()  #? The same, kept across changes: a version moves only when the ratings do
+prior_serial = 0
+segment_priors = OrderedDict()  #? segment key -> its aggregates, see build_segment
+prior_sums = prior_counts = prior_hist = None
+
+
+#! Function to bin ratings to tenths of a star for the histograms
+def rating_bins(ratings):
+    return np.clip(np.round(np.asarray(ratings, dtype=float) * 10), 0, RATING_BINS - 1).astype(int)
+
+
+#! Function to compute the population priors from every observed rating in the store
+def build_priors():
+    global prior_sums, prior_counts, prior_hist
+
+    observed = observed_matrix()
+    num_dishes = observed.shape[1]
+    with prior_lock:
+        prior_sums = np.bincount(observed.indices, weights=observed.data, minlength=num_dishes)
+        prior_counts = np.bincount(observed.indices, minlength=num_dishes)
+        prior_hist = np.zeros((num_dishes, RATING_BINS), dtype=np.int64)
+        np.add.at(prior_hist, (observed.indices, rating_bins(observed.data)), 1)
+        segment_priors.clear()
+        prior_cache.clear()
+
+
+#! Function to move whole (users x dishes) rows in the priors, NaN cells skipped; either side may be None.
+#! rows are the users' rows in the store, which the segments need; without them the segments are rebuilt on next use
+def update_priors(old_rows, new_rows, rows=None):
+    global prior_sums, prior_counts
+
+    with prior_lock:
+        for values, sign in ((old_rows, -1), (new_rows, 1)):
+            if values is None:
+                continue
+            values = np.atleast_2d(np.asarray(values, dtype=float))
+            observed = np.isfinite(values)
+            prior_sums += sign * np.where(observed, values, 0).sum(axis=0)
+            prior_counts += sign * observed.sum(axis=0)
+            cells, columns = np.nonzero(observed)
+            np.add.at(prior_hist, (columns, rating_bins(values[cells, columns])), sign)
+
+        if rows is None:
+            segment_priors.clear()
+        elif len(rows):
+            shape = np.shape(np.atleast_2d(new_rows if old_rows is None else old_rows))
+            old_rows = np.full(shape, np.nan) if old_rows is None else np.atleast_2d(old_rows)
+            new_rows = np.full(shape, np.nan) if new_rows is None else np.atleast_2d(new_rows)
+            move_segments(np.asarray(rows), slice(None), old_rows, new_rows)
+        prior_cache.clear()
+
+
+#! Function to move one of a user's ratings in the priors; None stands for a cell that is not observed
+def update_prior_cell(user_id, dish_id, old_rating, new_rating):
+    with prior_lock:
+        for rating, sign in ((old_rating, -1), (new_rating, 1)):
+            if rating is not None:
+                prior_sums[dish_id] += sign * rating
+                prior_counts[dish_id] += sign
+                prior_hist[dish_id, rating_bins(rating)] += sign
+        if segment_priors:
+            old = np.nan if old_rating is None else old_rating
+            new = np.nan if new_rating is None else new_rating
+            move_segments(np.array([user_index.get_loc(user_id)]), [dish_id], np.array([[old]]), np.array([[new]]))
+        prior_cache.clear()
+
+
+#! Function to get the per-dish mean rating
+def mean_prior(ingredients=None, meal_time=None):
+    return prior_sums / np.maximum(prior_counts, 1)
+
+
+#! Function to get the per-dish median rating from the histograms
+def median_prior(ingredients=None, meal_time=None):
+    cumulative = prior_hist.cumsum(axis=1)
+    lower = np.argmax(cumulative >= ((prior_counts + 1) // 2)[:, None], axis=1)
+    upper = np.argmax(cumulative >= (prior_counts // 2 + 1)[:, None], axis=1)
+    return (lower + upper) / 20
+
+
+#! Function to key a segment: the known ingredients and meal times a new user picked, as frozensets. A meal time
+#! may be one name or several (any of them), as in build_meal_time_mask
+def segment_key(ingredients=None, meal_time=None):
+    names = [] if meal_time is None else [meal_time] if isinstance(meal_time, str) else list(meal_time)
+    return (frozenset(name for name in ingredients or [] if name in ingredient_bits),
+            frozenset(name for name in names if name in meal_time_masks))
+
+
+#! Function to build a segment's aggregates from the observed ratings: its dishes, every user's rating sum and count
+#! over them, the fans (see sync_segment) and the fans' per-dish rating sums and counts
+def build_segment(key):
+    ingredients, meal_times = key
+    num_dishes = len(dish_names)
+    in_segment = np.ones(num_dishes, dtype=bool)
+    if ingredients:
+        in_segment &= (dish_ingredient_masks[:num_dishes] & build_pantry_mask(ingredients)).any(axis=1)
+    if meal_times:
+        in_segment &= build_meal_time_mask(sorted(meal_times))[:num_dishes]
+
+    observed = observed_matrix()
+    segment = observed[:, np.flatnonzero(in_segment)]
+    return {
+        'dishes': in_segment,
+        'sums': np.asarray(segment.sum(axis=1), dtype=float).ravel(),
+        'counts': np.diff(segment.indptr).astype(np.int64),
+        'fans': np.zeros(observed.shape[0], dtype=bool),
+        'fan_sums': np.zeros(num_dishes),
+        'fan_counts': np.zeros(num_dishes, dtype=np.int64),
+    }
+
+
+#! Function to give a segment's per-user aggregates a row for every user in the store
+def grow_segment(segment, num_users):
+    missing = num_users - len(segment['sums'])
+    if missing > 0:
+        for name in ('sums', 'counts', 'fans'):
+            segment[name] = np.concatenate([segment[name], np.zeros(missing, dtype=segment[name].dtype)])
+
+
+#! Function to move ratings in every kept segment; old and new are (rows x columns) arrays, NaN where not observed
+def move_segments(rows, columns, old, new):
+    delta = np.nan_to_num(new) - np.nan_to_num(old)
+    moved = np.isfinite(new).astype(np.int64) - np.isfinite(old)
+    for segment in segment_priors.values():
+        grow_segment(segment, rows.max() + 1)
+        in_segment = segment['dishes'][columns]
+        segment['sums'][rows] += delta[:, in_segment].sum(axis=1)
+        segment['counts'][rows] += moved[:, in_segment].sum(axis=1)
+        fans = segment['fans'][rows]
+        segment['fan_sums'][columns] += delta[fans].sum(axis=0)
+        segment['fan_counts'][columns] += moved[fans].sum(axis=0)
+
+
+#! Function to bring a segment's fans up to date: users whose mean observed rating in the segment is at least the
+#! average of those means. Only the users who crossed the line since the last read move the fans' sums
+def sync_segment(segment):
+    grow_segment(segment, len(user_index))
+    rated = segment['counts'] > 0
+    affinity = segment['sums'] / np.maximum(segment['counts'], 1)
+    fans = rated & (affinity >= affinity[rated].mean()) if rated.any() else np.zeros(len(rated), dtype=bool)
+
+    flipped = np.flatnonzero(fans != segment['fans'])
+    if len(flipped):
+        ratings = observed_matrix(flipped)
+        signs = np.repeat(np.where(fans[flipped], 1, -1), np.diff(ratings.indptr))
+        num_dishes = len(segment['fan_sums'])
+        segment['fan_sums'] += np.bincount(ratings.indices, weights=signs * ratings.data, minlength=num_dishes)
+        segment['fan_counts'] += np.bincount(ratings.indices, weights=signs, minlength=num_dishes).astype(np.int64)
+        segment['fans'] = fans
+
+
+#! Function to get the mean rating among users who like the kind of dish the new user picked (ingredients and meal time),
+#! over observed ratings only; a dish no such user has rated keeps its overall mean
+def segment_prior(ingredients=None, meal_time=None):
+    key = segment_key(ingredients, meal_time)
+    if key not in segment_priors:
+        segment_priors[key] = build_segment(key)
+        while len(segment_priors) > SEGMENT_CACHE_SIZE:
+            segment_priors.popitem(last=False)
+    segment_priors.move_to_end(key)
+
+    segment = segment_priors[key]
+    sync_segment(segment)
+    return np.where(segment['fan_counts'] > 0, segment['fan_sums'] / np.maximum(segment['fan_counts'], 1), mean_prior())
+
+
+COLD_START_PRIORS = {'mean': mean_prior, 'median': median_prior, 'segment': segment_prior}
+
+
+#! Function to predict a new user's ratings with the configured cold-start prior
+def cold_start_ratings(ingredients=None, meal_time=None, strategy=None):
+    return cold_start_prior(ingredients, meal_time, strategy)[0].copy()
+
+
+#! Function to get the cold-start ratings of a segment with their version (see rating_version), computed once per change
+#! of the ratings; the arrays are shared, so callers copy before writing
+def cold_start_prior(ingredients=None, meal_time=None, strategy=None):
+    global prior_serial
+
+    strategy = strategy or COLD_START
+    key = (strategy, segment_key(ingredients, meal_time) if strategy == 'segment' else None)
+    with prior_lock:
+        if key not in prior_cache:
+            prior = np.round(np.clip(COLD_START_PRIORS[strategy](ingredients, meal_time), 1, 5), 1)
+            last = prior_versions.get(key)
+            if last is None or not np.array_equal(last[0], prior):
+                prior_serial += 1
+                last = (prior, prior_serial)
+            prior_cache[key] = prior_versions[key] = last
+            prior_versions.move_to_end(key)
+            while len(prior_versions) > SEGMENT_CACHE_SIZE:
+                prior_versions.popitem(last=False)
+        return prior_cache[key]
+
+
+#! Function to save the priors next to the ratings snapshot they were computed from
+def save_priors():
+    with atomic_write(PRIORS_PATH, 'wb') as f:
+        np.savez(f, sums=prior_sums, counts=prior_counts, hist=prior_hist,
+                 source=np.array(csv_signature(SURVEY_PATH)))
+
+
+#! Function to load saved priors, only when they match the CSV and no journal was replayed on top of it
+def load_priors():
+    global prior_sums, prior_counts, prior_hist
+
+    if journal_records or not os.path.exists(PRIORS_PATH):
+        return False
+    with np.load(PRIORS_PATH) as saved:
+        if saved['source'].tolist() != csv_signature(SURVEY_PATH) or saved['sums'].shape != (len(dish_names),):
+            return False
+        with prior_lock:
+            prior_sums, prior_counts, prior_hist = saved['sums'], saved['counts'], saved['hist']
+            segment_priors.clear()
+            prior_cache.clear()
+    return True
+
+
+#! Optional latent-factor engine: ratings ~ mean + U[user] @ V.T, fit by weighted ALS on the observed ratings on first use.
+#! Feedback folds the user's row back in against the fixed dish factors; train_factors() refits everything
+RECOMMENDATION_ENGINE = 'ratings'
+FACTOR_RANK = 8
+FACTOR_REGULARIZATION = 0.1
+FACTOR_ITERATIONS = 15
+
+user_factors = None
+dish_factors = None
+factor_mean = 0.0
+factor_rows = {}
+
+
+#! Function to solve one ridge regression per row of a sparse (rows x columns) matrix of centered ratings: row i fits its
+#! stored cells over the factors of their columns, so the work follows the ratings rather than rows x columns
+def sparse_least_squares(factors, centered):
+    rank = factors.shape[1]
+    outer = (factors[:, :, None] * factors[:, None, :]).reshape(len(factors), rank * rank)
+    pattern = sparse.csr_matrix((np.ones(centered.nnz), centered.indices, centered.indptr), shape=centered.shape)
+    grams = (pattern @ outer).reshape(-1, rank, rank) + FACTOR_REGULARIZATION * np.eye(rank)
+    return np.linalg.solve(grams, (centered @ factors)[:, :, None])[:, :, 0]
+
+
+#! Function to center users' ratings (store rows, all by default) on factor_mean: their observed cells as a CSR matrix,
+#! plus the rows of those who have not rated anything yet and those users' dense cold-start prior
+def centered_ratings(rows=None):
+    observed = observed_matrix(rows)
+    centered = sparse.csr_matrix((observed.data - factor_mean, observed.indices, observed.indptr), shape=observed.shape)
+    unrated = np.flatnonzero(np.diff(observed.indptr) == 0)
+    user_ids = user_index if rows is None else user_index[rows]
+    return centered, unrated, rating_rows(user_ids[unrated]) - factor_mean
+
+
+#! Function to fit users' factors against the fixed dish factors: over their observed ratings, or over every dish (their
+#! cold-start prior) for a user who has not rated anything yet, so they still get the prior's shape
+def fit_users(centered, unrated, priors):
+    factors = sparse_least_squares(dish_factors, centered)
+    if len(unrated):
+        gram = dish_factors.T @ dish_factors + FACTOR_REGULARIZATION * np.eye(dish_factors.shape[1])
+        factors[unrated] = np.linalg.solve(gram, (priors @ dish_factors).T).T
+    return factors
+
+
+#! Function to fit user and dish factors with alternating least squares over the observed ratings. Cold-start values
+#! never reach the mean or the dish factors. Both half-steps work on the CSR rows of the store (and its transpose)
+def train_factors(seed=0):
+    global user_factors, dish_factors, factor_mean, factor_rows
+
+    observed = observed_matrix()
+    factor_mean = observed.data.mean() if observed.nnz else cold_start_ratings().mean()
+    centered, unrated, priors = centered_ratings()
+    columns = centered.T.tocsr()
+    rank = min(FACTOR_RANK, *centered.shape)
+
+    dish_factors = np.random.default_rng(seed).normal(scale=0.1, size=(centered.shape[1], rank))
+    for _ in range(FACTOR_ITERATIONS):
+        user_factors = fit_users(centered, unrated, priors)
+        dish_factors = sparse_least_squares(user_factors, columns)
+    factor_rows = {user_id: row for row, user_id in enumerate(user_index)}
+    clear_recommendation_cache()
+
+
+#! Function to re-solve one user's factors against the fixed dish factors, O(rated dishes x rank^2)
+def fold_in_user(user_id):
+    global user_factors
+
+    if dish_factors is None:
+        return
+
+    factors = fit_users(*centered_ratings([user_index.get_loc(user_id)]))[0]
+    if user_id in factor_rows:
+        user_factors[factor_rows[user_id]] = factors
+    else:
+        #? The row exists before its index is published, so a reader never sees an index past the end
+        user_factors = np.vstack([user_factors, factors])
+        factor_rows[user_id] = len(user_factors) - 1
+
+
+#! Function to score dishes by the user's own ratings (the original engine)
+def rating_scores(user_ids, ratings):
+    return ratings
+
+
+#! Function to get the factors ready to read for the given users: trained on first use and any user without a row folded
+#! in. Like current_similarity() the work happens under the state writer, so readers never change the factors themselves
+def current_factors(user_ids=()):
+    if dish_factors is None or any(user_id not in factor_rows for user_id in user_ids):
+        with state_writer():
+            if dish_factors is None:
+                train_factors()
+            for user_id in user_ids:
+                if user_id not in factor_rows:
+                    fold_in_user(user_id)
+
+
+#! Function to score dishes by predicted rating from the factors
+def factor_scores(user_ids, ratings):
+    current_factors(user_ids)
+    rows = [factor_rows[user_id] for user_id in user_ids]
+    return factor_mean + user_factors[rows] @ dish_factors.T
+
+
+RECOMMENDATION_ENGINES = {'ratings': rating_scores, 'factors': factor_scores}
+
+
+#! Function to add a user with ratings predicted by the cold-start prior. An existing user is never replaced: returns
+#! False and leaves their ratings alone when the id is taken (checked under the writer, so two creations cannot race)
+def add_user(user_id, name, ingredients=None, meal_time=None):
+    segment = segment_key(ingredients, meal_time)
+
+    with state_writer():
+        if user_id in user_index:
+            return False
+
+        #? The new row stores no cell: every dish reads as the prior, so the similarity and priors do not move
+        append_users([user_id], np.full((1, len(dish_names)), np.nan))
+        if any(segment):
+            user_segments[user_id] = segment
+        invalidate_user(user_id)
+        fold_in_user(user_id)
+        journal_join(user_id, segment)
+        users[user_id] = name
+    return True
+
+
+#! Function to merge a batch of survey rows (indexed by UserID, one column per dish, NaN where no rating was given).
+#! Known users have the given cells overwritten and keep their other ratings; new users read the cold-start prior for
+#! the rest. Similarity, priors and factors follow with one update for the whole batch instead of a recompute
+def merge_ratings(batch):
+    with state_writer():
+        batch = batch[~batch.index.duplicated(keep='last')].reindex(columns=dish_names)
+        given_values = batch.values.astype(float)
+        given = np.isfinite(given_values)
+        known = batch.index.isin(user_index)
+        known_ids = batch.index[known]
+
+        old_rows = np.full(given.shape, np.nan)
+        old_rows[known] = observed_ratings(known_ids)
+        new_rows = np.where(given, given_values, old_rows)
+
+        #? New users are appended in batch order after the current rows
+        rows = np.empty(len(batch), dtype=np.int64)
+        rows[known] = user_index.get_indexer(known_ids)
+        rows[~known] = len(user_index) + np.arange((~known).sum())
+
+        add_similarity_rows(np.nan_to_num(old_rows), np.nan_to_num(new_rows))
+        update_priors(old_rows, new_rows, rows)
+
+        replace_rows(user_index.get_indexer(known_ids), new_rows[known])
+        append_users(batch.index[~known], new_rows[~known])
+
+        for user_id in batch.index:
+            users.setdefault(user_id, str(user_id))
+            invalidate_user(user_id)
+            fold_in_user(user_id)
+
+
+#! Function to validate if a user exists in the system based on their ID
+def validate_user(user_id):
+    return user_id in user_index
+
+
+#! Function to compute the top-K neighbor rows for the given dishes with a partition instead of a full sort
+def compute_neighbors(dish_ids):
+    #? Columns are reversed so top_n_rows' lower-id-first tie rule gives the higher-id-first order of the reversed argsort
+    rows = dish_similarity[dish_ids]
+    ids, scores = top_n_rows(rows[:, ::-1], np.ones(rows.shape, dtype=bool), NEIGHBORHOOD_SIZE + 1)
+    return rows.shape[1] - 1 - ids, scores
+
+
+#! Function to build the dense neighbor table, the top NEIGHBORHOOD_SIZE neighbors of every dish
+def build_neighbor_table():
+    global neighbor_table, neighbor_scores
+
+    neighbor_table, neighbor_scores = compute_neighbors(np.arange(len(dish_names)))
+
+
+#! Function to refresh the neighbor table after the similarity rows and columns of some dishes changed
+def refresh_neighbors(dish_ids):
+    if neighbor_table is None:
+        return
+
+    #? Only rows that held one of the dishes or that one can now enter need their top-K recomputed
+    columns = dish_similarity[:, dish_ids]
+    stale = np.isin(neighbor_table, dish_ids).any(axis=1) | (columns >= neighbor_scores[:, -1:]).any(axis=1)
+    stale[dish_ids] = True
+    rows = np.flatnonzero(stale)
+    neighbor_table[rows], neighbor_scores[rows] = compute_neighbors(rows)
+    neighbor_versions[rows] += 1
+
+
+#! Function to select the neighborhood of similar items for a given item
+def select_neighborhood(similarity_matrix, item_id, neighborhood_size):
+    #? Neighborhoods of dish_similarity come straight from the neighbor table that current_similarity() keeps:
+    #? NEIGHBORHOOD_SIZE wide for the dense similarity, SIMILARITY_TOP_K wide for the sparse one
+    if similarity_matrix is dish_similarity and neighbor_table is not None and neighborhood_size < neighbor_table.shape[1]:
+        return neighbor_table[item_id, 1:neighborhood_size+1].copy()  # Exclude the item itself
+
+    item_similarity_scores = similarity_matrix[item_id]
+    if sparse.issparse(item_similarity_scores):
+        item_similarity_scores = item_similarity_scores.toarray().ravel()
+    sorted_indices = np.argsort(item_similarity_scores)[::-1]
+    neighborhood = sorted_indices[1:neighborhood_size+1]  # Exclude the item itself
+    return neighborhood
+
+
+#! Function to pick the top N candidates by score with argpartition, ties going to the lower dish id like a stable sort
+def top_n_dishes(scores, candidates, n):
+    idx = np.flatnonzero(candidates)
+    if len(idx) > n:
+        if n <= 0:
+            return idx[:0]
+        candidate_scores = scores[idx]
+        kth = np.partition(candidate_scores, len(idx) - n)[len(idx) - n]
+        above = idx[candidate_scores > kth]
+        ties = idx[candidate_scores == kth][:n - len(above)]
+        idx = np.concatenate([above, ties])
+    return idx[np.lexsort((idx, -scores[idx]))]
+
+
+#! Function to recommend dishes for a user from their ratings, what they can cook (ingredient names) and when they eat
+#! (a meal time name, several names, a dish mask, or None for no filter). Returns the path that answered, 'ranked'
+#! (fully cookable dishes), 'partial' (a substitute or at most MAX_MISSING_INGREDIENTS missing) or 'retry' (cookable
+#! neighbors of the candidates), and the (dish id, score) list; the entry points tell the user about the fallbacks
+def recommend(user_id, available_ingredients, meal_time=None, num_recommendations=5, engine=None):
+    num_dishes = len(dish_names)
+    meal_time_mask = build_meal_time_mask(meal_time)
+    servable = np.ones(num_dishes, dtype=bool) if meal_time_mask is None else meal_time_mask[:num_dishes].copy()
+    pantry = build_pantry_mask(available_ingredients)
+
+    #? A repeat request with the same pantry and meal time is a dictionary lookup
+    engine = engine or RECOMMENDATION_ENGINE
+    key = (user_id, pantry.tobytes(), servable.tobytes(), num_recommendations, engine)
+    cached = cached_recommendations(key)
+    if cached is not None:
+        path, result = cached
+        count('recommendations', 'cached_' + path)
+        return path, list(result)
+    state = state_version
+    version = rating_version(user_id)
+
+    user_ratings = rating_row(user_id)
+    scores = (RECOMMENDATION_ENGINES[engine]([user_id], user_ratings[None]) - recent_penalties([user_id], num_dishes))[0]
+
+    #? Meal time goes first, then the rating threshold and recent-dish exclusion, all as one boolean candidate mask
+    start = time.perf_counter()
+    candidates = servable & (user_ratings < 3) & ~recent_mask(user_id, num_dishes)
+
+    #? Filter based on ingredients, only for the dishes still in the running
+    candidate_ids = np.flatnonzero(candidates)
+    cookable_candidates = np.zeros(num_dishes, dtype=bool)
+    cookable_candidates[candidate_ids] = cookable_dishes(pantry, candidate_ids)
+    top = top_n_dishes(scores, cookable_candidates, num_recommendations)
+    if METRICS_ENABLED:
+        observe('candidate_filter', start)
+    if len(top):
+        recommendations = [(int(i), scores[i]) for i in top]
+        cache_recommendations(key, state, version, 'ranked', recommendations)
+        count('recommendations', 'ranked')
+        return 'ranked', list(recommendations)
+
+    #? Next, the candidates that are close enough: a substitute or at most MAX_MISSING_INGREDIENTS missing
+    start = time.perf_counter()
+    top = partial_matches(scores, candidates, pantry, num_recommendations)
+    if METRICS_ENABLED:
+        observe('partial_match', start)
+    if len(top):
+        recommendations = [(int(i), scores[i]) for i in top]
+        cache_recommendations(key, state, version, 'partial', recommendations)
+        count('recommendations', 'partial')
+        return 'partial', list(recommendations)
+
+    #? Retry with cosine similarity, still never offering a dish outside the meal time. This is the expensive path;
+    #? its share of the 'recommendations' count is the rate to watch
+    start = time.perf_counter()
+    #? Read before the retry reads the neighbors; the similarity is not built yet if they do not cover every dish
+    dish_versions = neighbor_versions[candidate_ids].copy() if len(neighbor_versions) == num_dishes else None
+    recommendations = [(int(i), scores[i]) for i in top_n_dishes(scores, candidates, num_dishes)]
+    cookable = cookable_dishes(pantry)[:num_dishes] & servable
+    recommendations = retry_cosine_similarity(user_id, recommendations, cookable)[:num_recommendations]
+    cache_recommendations(key, state, version, 'retry', recommendations, candidate_ids, dish_versions)
+    count('recommendations', 'retry')
+    if METRICS_ENABLED:
+        observe('retry_fallback', start)
+    return 'retry', list(recommendations)
+
+
+#! Function to get recommendations for many users at once, returning (users x n) dish ids and scores padded with -1 / nan.
+#! Every user is counted under the path that answered them, as in recommend, and the fallbacks are timed under its
+#! stages; the chunked ranking is timed as one 'batch_ranking' stage. Results are not cached: recommend caches per user
+def get_recommendations_batch(user_ids, pantry_masks, meal_times=None, n=5, chunk_size=1024, engine=None):
+    user_ids = list(user_ids)
+    pantry_masks = np.asarray(pantry_masks, dtype=np.uint64).reshape(len(user_ids), -1)
+    num_dishes = len(dish_names)
+
+    dish_ids = np.full((len(user_ids), n), -1, dtype=np.int64)
+    scores = np.full((len(user_ids), n), np.nan)
+
+    #? Meal times may be names or boolean masks per user; None (or an unknown name) means no filter
+    if meal_times is not None:
+        meal_times = np.array([
+            np.ones(len(dish_in_inventory), dtype=bool) if mask is None else mask
+            for mask in map(build_meal_time_mask, meal_times)
+        ])
+
+    start = time.perf_counter()
+    for chunk_start in range(0, len(user_ids), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        chunk_users = user_ids[chunk]
+        ratings = rating_rows(chunk_users)
+
+        candidates = (ratings < 3) & ~recent_masks(chunk_users, num_dishes)
+        if meal_times is not None:
+            candidates &= np.asarray(meal_times[chunk], dtype=bool)[:, :num_dishes]
+
+        #? Subset check for every (user, dish) pair of the chunk in one broadcast
+        missing = (dish_ingredient_masks[None, :num_dishes] & ~pantry_masks[chunk, None, :]).any(axis=2)
+        candidates &= dish_in_inventory[:num_dishes] & ~missing
+
+        chunk_scores = RECOMMENDATION_ENGINES[engine or RECOMMENDATION_ENGINE](chunk_users, ratings)
+        chunk_scores = chunk_scores - recent_penalties(chunk_users, num_dishes)
+        chunk_ids, chunk_scores = top_n_rows(chunk_scores, candidates, n)
+        dish_ids[chunk, :chunk_ids.shape[1]] = chunk_ids
+        scores[chunk, :chunk_scores.shape[1]] = chunk_scores
+    if METRICS_ENABLED:
+        observe('batch_ranking', start)
+    fallback_rows = np.flatnonzero(dish_ids[:, 0] < 0) if n > 0 else []
+    if len(user_ids) > len(fallback_rows):
+        count('recommendations', 'ranked', len(user_ids) - len(fallback_rows))
+
+    #? Users with no cookable candidate go through the same partial match and retry fallback as recommend
+    for row in fallback_rows:
+        user_id = user_ids[row]
+        ratings = rating_row(user_id)
+        user_scores = RECOMMENDATION_ENGINES[engine or RECOMMENDATION_ENGINE]([user_id], ratings[None])
+        user_scores = (user_scores - recent_penalties([user_id], num_dishes))[0]
+        candidates = (ratings < 3) & ~recent_mask(user_id, num_dishes)
+        if meal_times is not None:
+            candidates &= np.asarray(meal_times[row], dtype=bool)[:num_dishes]
+        start = time.perf_counter()
+        top = partial_matches(user_scores, candidates, pantry_masks[row], n)
+        if METRICS_ENABLED:
+            observe('partial_match', start)
+        if len(top):
+            dish_ids[row, :len(top)] = top
+            scores[row, :len(top)] = user_scores[top]
+            count('recommendations', 'partial')
+            continue
+
+        start = time.perf_counter()
+        cookable = cookable_dishes(pantry_masks[row])[:num_dishes]
+        if meal_times is not None:
+            cookable &= meal_times[row][:num_dishes]
+        recommendations = [(int(i), user_scores[i]) for i in top_n_dishes(user_scores, candidates, num_dishes)]
+        retry = retry_cosine_similarity(user_id, recommendations, cookable)[:n]
+        dish_ids[row, :len(retry)] = [i for i, _ in retry]
+        scores[row, :len(retry)] = [score for _, score in retry]
+        count('recommendations', 'retry')
+        if METRICS_ENABLED:
+            observe('retry_fallback', start)
+
+    return dish_ids, scores
+
+
+#! Function to pick the top N candidates of every row, in the same order top_n_dishes gives for a single user
+def top_n_rows(scores, candidates, n):
+    num_rows, num_dishes = scores.shape
+    if n <= 0 or num_dishes == 0:
+        return np.empty((num_rows, 0), dtype=np.int64), np.empty((num_rows, 0))
+
+    masked = np.where(candidates, scores, -np.inf)
+    selected = candidates
+    if num_dishes > n:
+        kth = np.partition(masked, num_dishes - n, axis=1)[:, num_dishes - n, None]
+        above = candidates & (masked > kth)
+        ties = candidates & (masked == kth)
+        needed = n - above.sum(axis=1, keepdims=True)
+        selected = above | (ties & (np.cumsum(ties, axis=1) <= needed))
+
+    #? Selected dish ids in ascending order, then a stable sort by score keeps lower ids first on ties
+    width = min(n, num_dishes)
+    ids = np.argsort(~selected, axis=1, kind='stable')[:, :width]
+    valid = np.take_along_axis(selected, ids, axis=1)
+    top_scores = np.where(valid, np.take_along_axis(masked, ids, axis=1), -np.inf)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    ids = np.take_along_axis(ids, order, axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    return np.where(valid, ids, -1), np.where(valid, top_scores, np.nan)
+
+
+#! Function to check if a dish's ingredients are available to the user based on their selection
+def check_ingredients(dish_id, available_ingredients):
+    if not 0 <= dish_id < len(dish_in_inventory) or not dish_in_inventory[dish_id]:
+        return False
+
+    missing = dish_ingredient_masks[dish_id] & ~build_pantry_mask(available_ingredients)
+    return not missing.any()
+
+
+#! Function to retry recommendations using cosine similarity for dishes that have similar ingredients to the user's selection but were not recommended initially due to low ratings
+def retry_cosine_similarity(user_id, recommendations, cookable):
+    similarity = current_similarity()
+
+    retry_recommendations = []
+    for i, score in recommendations:
+        hood = select_neighborhood(similarity, i, 5)
+        for neighbor in hood:
+            if cookable[neighbor]:
+                retry_recommendations.append((neighbor, similarity[i, neighbor]))
+
+    return retry_recommendations if retry_recommendations else []
+
+
+#! Function to move a user's ratings after they selected dishes, in memory only, and return the dishes whose ratings
+#! changed. rating is how they rated the recommendations (3 is neutral). Each neighborhood is adjusted, clipped and
+#! rounded as one array and written with set_ratings; the fold-in happens once for the list
+@timed('feedback_apply')
+def adjust_ratings(user_id, dish_ids, rating=3, neighborhood_size=5):
+    user_ratings = rating_row(user_id)
+    rating_adjustment = 0.1 * (rating - 3)
+    changed = set()
+
+    for selected_dish in dish_ids:
+        #? A neighborhood depends on the similarity the previous selections moved, so each is read in turn
+        similarity_matrix = current_similarity()
+        hood = select_neighborhood(similarity_matrix, selected_dish, neighborhood_size)
+        #? Every dish of the neighborhood is adjusted, as over the baseline's dense table: a dish the user had not rated
+        #? moves from their cold-start prior and is stored as their rating from here on
+        current_ratings = user_ratings[hood]
+        similarity = similarity_matrix[selected_dish, hood]
+        if sparse.issparse(similarity):
+            similarity = similarity.toarray().ravel()
+        adjustment = np.where(similarity < 0.5, 0.1, np.where(current_ratings > 1.2, -0.2, 0))
+
+        new_ratings = np.round(np.clip(current_ratings + (rating_adjustment + adjustment), 1, 5), 1)
+        set_ratings(user_id, hood, new_ratings)
+        user_ratings[hood] = new_ratings
+        changed.update(int(i) for i in hood)
+        count('neighbor_updates', amount=len(hood))
+
+        #? Track the recently selected dish, the ring buffer keeps the last RECENT_HISTORY
+        remember_selection(user_id, selected_dish)
+
+    invalidate_user(user_id)
+    fold_in_user(user_id)
+    return changed
+
+
+#! Function to apply one rating to a list of selected dishes (a rated recommendation list, then the dish picked from
+#! it), with the same result as calling update_data for each dish in turn, and journal the selections and the changed
+#! ratings with one write
+def apply_feedback(user_id, dish_ids, rating=3, neighborhood_size=5):
+    with state_writer():
+        changed = adjust_ratings(user_id, dish_ids, rating, neighborhood_size)
+        journal_ratings(user_id, sorted(changed), dish_ids)
+
+
+#! Function to update the data based on the user's selection and adjust the ratings of similar dishes
+def update_data(user_id, selected_dish, rating=3, neighborhood_size=5):
+    apply_feedback(user_id, [selected_dish], rating, neighborhood_size)
+
+
+#! Function to apply queued selections in arrival order, as update_data would one by one, but with one journal write
+#! per user and one fsync for the whole batch. Selections naming an unknown user or dish are skipped and returned
+@timed('feedback_batch')
+def apply_feedback_batch(events, rating=3):
+    failed = []
+    if not events:
+        return failed
+
+    with state_writer():
+        changed = {}
+        selected = {}
+        for user_id, dish_id in events:
+            try:
+                hood = adjust_ratings(user_id, [dish_id], rating)
+            except (KeyError, IndexError):
+                failed.append((user_id, dish_id))
+                continue
+            changed.setdefault(user_id, set()).update(hood)
+            selected.setdefault(user_id, []).append(dish_id)
+
+        for user_id, dish_ids in changed.items():
+            journal_ratings(user_id, sorted(dish_ids), selected[user_id])
+        sync_journal()
+    return failed
+
+
+#! Shared state: one writer at a time (state_lock between threads, an flock on LOCK_PATH between processes) and
+#! lock-free readers that retry when state_version moved under them. Processes over the same files see each other's
+#! writes by tailing the shared journal, which the writer catches up on before every change
+LOCK_PATH = "Food survey.lock"
+state_lock = threading.RLock()
+state_version = 0
+writer_depth = 0
+
+
+#! Function to hold the writer for a change (reentrant), caught up with what other processes journaled first
+@contextmanager
+def state_writer():
+    global state_version, writer_depth, journal_offset, journal_inode
+
+    with state_lock:
+        if writer_depth:
+            writer_depth += 1
+            try:
+                yield
+            finally:
+                writer_depth -= 1
+            return
+
+        with open(LOCK_PATH, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            writer_depth = 1
+            state_version += 1  #? Odd while a write is in progress
+            try:
+                apply_journal_changes()
+                yield
+            finally:
+                #? Everything up to here is either ours or already applied
+                journal_inode = journal_identity()
+                journal_offset = os.path.getsize(JOURNAL_PATH) if journal_inode is not None else 0
+                state_version += 1
+                writer_depth = 0
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+#! Function to run a reader without taking a lock (seqlock style): it is rerun if a write overlapped it
+def read_state(reader):
+    while True:
+        version = state_version
+        if version % 2 == 0:
+            try:
+                result = reader()
+            except Exception:
+                if state_version == version:
+                    raise
+                continue
+            if state_version == version:
+                return result
+        time.sleep(0)
+
+
+#! Function to check whether another process wrote to (or compacted) the journal since this one last held the writer
+def journal_changed():
+    if journal_identity() != journal_inode:
+        return True
+    return os.path.exists(JOURNAL_PATH) and os.path.getsize(JOURNAL_PATH) != journal_offset
+
+
+#! Function to pick up what other processes journaled, if anything, before serving a read
+def catch_up():
+    if journal_changed():
+        with state_writer():
+            pass
+
+
+#! Function to apply the records other processes appended since the last write; the caller holds the writer
+def apply_journal_changes():
+    global journal_offset
+
+    if journal_identity() != journal_inode:
+        #? Another process compacted: the snapshot already holds everything, reload it
+        close_journal()
+        load_state()
+        return
+
+    records, selections, joins, journal_offset = read_journal(journal_offset)
+    latest = latest_records(records)
+    user_segments.update((user_id, segment) for user_id, segment in joins if any(segment))
+    for user_id, cells in latest.items():
+        if user_id in user_index and cells:
+            ids = list(cells)
+            set_ratings(user_id, ids, np.array([cells[i] for i in ids]))
+            fold_in_user(user_id)
+
+    #? Users another process created arrive as one block of rows, NaN where the journal has no rating
+    new_users = [user_id for user_id in dict.fromkeys([user_id for user_id, _ in joins] + list(latest))
+                 if user_id not in user_index]
+    if new_users:
+        ratings = np.full((len(new_users), len(dish_names)), np.nan)
+        for row, user_id in enumerate(new_users):
+            cells = latest.get(user_id, {})
+            ratings[row, list(cells)] = list(cells.values())
+        append_users(new_users, ratings)
+        add_similarity_rows(np.zeros(ratings.shape), np.nan_to_num(ratings))
+        update_priors(None, ratings, user_index.get_indexer(new_users))
+        for user_id in new_users:
+            invalidate_user(user_id)
+            fold_in_user(user_id)
+            users.setdefault(user_id, str(user_id))
+
+    dish_ids = {dish: i for i, dish in enumerate(dish_names)}
+    for when, user_id, dish in selections:
+        if user_id in user_index and dish in dish_ids:
+            remember_selection(user_id, dish_ids[dish], when)
+            invalidate_user(user_id)
+
+
+#! Function to load the engine's state from the data files in the working directory: the ratings snapshot with the
+#! journal replayed over it, the inventory, the segments, the recent history and the priors. Importing the engine reads
+#! nothing, so the front ends call this once before anything else, after changing any settings; it runs again when
+#! another process compacted. The similarity and the factors are built on first use
+@timed('data_load')
+def load_state():
+    global user_index, dish_names, stored_ratings
+
+    user_index, dish_names, stored_ratings = load_ratings()
+    load_inventory()
+    load_segments()
+    replay_journal()
+    for user_id in user_index:
+        users.setdefault(user_id, str(user_id))
+    restore_recent()
+    drop_similarity()
+    if not load_priors():
+        build_priors()
+    if dish_factors is not None:
+        train_factors()
@@ -0,0 +1,377 @@
+import importlib
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from benchmark import generate_inventory, generate_survey
+
+#! Checks of the engine (recommender.py) against its own rebuild paths. Each test runs the engine over a copy of the
+#! survey and the inventory in a scratch directory, since it reads and writes its data files in the working directory
+REPO = os.path.dirname(os.path.abspath(__file__))
+DATA_FILES = ["Food survey.csv", "temp_dish_inventory.csv"]
+
+#? The sparse top-K form, on a catalogue small enough to compare with its rebuild
+SPARSE_SETTINGS = {'DENSE_SIMILARITY_LIMIT': 8, 'SIMILARITY_TOP_K': 5}
+
+
+#! Fixture to load a fresh engine over the data files of a scratch directory, with settings changed before the load:
+#! a copy of the real survey and inventory, or with synthetic set a small survey most cells of which are unrated.
+#! Loading the same directory again reads back what the previous engine left there
+@pytest.fixture
+def load_engine(tmp_path, monkeypatch):
+    engines = []
+
+    def load(directory='data', synthetic=False, **settings):
+        path = tmp_path / directory
+        if not path.exists():
+            path.mkdir()
+            if synthetic:
+                rng = np.random.default_rng(7)
+                generate_survey(200, 12, 0.3, rng).to_csv(path / DATA_FILES[0], index=False)
+                generate_inventory(12, 20, 4, rng).to_csv(path / DATA_FILES[1], index=False)
+            for name in [] if synthetic else DATA_FILES:
+                shutil.copy(os.path.join(REPO, name), path)
+        if engines:
+            engines[-1].close_journal()
+        monkeypatch.chdir(path)
+        sys.modules.pop('recommender', None)
+        engine = importlib.import_module('recommender')
+        for name, value in settings.items():
+            setattr(engine, name, value)
+        engine.load_state()
+        engines.append(engine)
+        return engine
+
+    yield load
+    for engine in engines:
+        engine.close_journal()
+    sys.modules.pop('recommender', None)
+
+
+#! Function to read the engine's current similarity as a dense array
+def similarity_array(engine):
+    similarity = engine.current_similarity()
+    return similarity.toarray() if sparse.issparse(similarity) else similarity.copy()
+
+
+#! Function to change the store through feedback and a sign-up, then, with merge set, a merged batch of survey rows
+#! (which is not journaled: an import compacts once it is done)
+def change_ratings(engine, merge=True):
+    first, second = engine.user_index[:2]
+    engine.update_data(first, 3, 5)
+    engine.apply_feedback(second, [1, 2, 4], 2)
+    engine.add_user(900001, 'new', engine.ingredient_columns[:3], engine.meal_time_columns[:1])
+    engine.update_data(900001, 6, 4)
+    if not merge:
+        return
+
+    batch = pd.DataFrame(np.nan, index=pd.Index([first, 900002], name='UserID'), columns=engine.dish_names)
+    batch.iloc[0, :4] = [1.0, 2.5, 4.0, 5.0]
+    batch.iloc[1, 5:9] = [3.0, 3.5, 4.5, 2.0]
+    engine.merge_ratings(batch)
+
+
+#! Function to capture what the data files must bring back
+def engine_state(engine):
+    return {
+        'users': list(engine.user_index),
+        'dishes': list(engine.dish_names),
+        'ratings': engine.observed_matrix().toarray(),
+        'segments': dict(engine.user_segments),
+        'recent': {user_id: engine.recent_selections(user_id) for user_id in engine.user_index[:2].tolist() + [900001]},
+    }
+
+
+def assert_same_state(state, expected):
+    assert state['users'] == expected['users']
+    assert state['dishes'] == expected['dishes']
+    np.testing.assert_array_equal(state['ratings'], expected['ratings'])
+    assert state['segments'] == expected['segments']
+    assert state['recent'] == expected['recent']
+
+
+@pytest.mark.parametrize('settings', [{}, SPARSE_SETTINGS], ids=['dense', 'sparse'])
+def test_incremental_similarity_matches_rebuild(load_engine, settings):
+    engine = load_engine(**settings)
+    similarity_array(engine)  #? Built first, so every change below goes through the incremental path
+    change_ratings(engine)
+    incremental = similarity_array(engine)
+
+    engine.rebuild_similarity()
+    np.testing.assert_allclose(incremental, similarity_array(engine), atol=1e-6)
+
+
+def test_journal_replay_restores_state(load_engine):
+    engine = load_engine()
+    change_ratings(engine, merge=False)
+    expected = engine_state(engine)
+    assert os.path.getsize(engine.JOURNAL_PATH) > 0
+
+    assert_same_state(engine_state(load_engine()), expected)
+
+
+def test_snapshot_round_trip(load_engine):
+    engine = load_engine()
+    change_ratings(engine)
+    expected = engine_state(engine)
+    with engine.state_writer():
+        engine.compact_journal()
+    assert os.path.getsize(engine.JOURNAL_PATH) == 0
+
+    engine = load_engine()
+    assert_same_state(engine_state(engine), expected)
+
+    #? The snapshot itself, written and read back directly
+    engine.export_ratings(engine.user_index, engine.dish_names, engine.stored_ratings, "copy.ratings")
+    index, columns, ratings = engine.read_ratings("copy.ratings")
+    assert list(index) == expected['users'] and list(columns) == expected['dishes']
+    values = ratings.data / engine.cell_scale(ratings)
+    np.testing.assert_array_equal(sparse.csr_matrix((values, ratings.indices, ratings.indptr), shape=ratings.shape).toarray(),
+                                  expected['ratings'])
+
+
+#! Function to run the baseline update_data on a dense copy: ratings is the users' table as the engine reads it,
+#! observed the same with 0 where nobody rated. The baseline computed the similarity once at start; the engine keeps it
+#! current, so here it is recomputed over observed before every selection
+def baseline_update_data(observed, ratings, row, selected_dish, recommendation_rating, neighborhood_size=5):
+    norms = np.linalg.norm(observed, axis=0)
+    dish_similarity = (observed.T @ observed) / np.outer(norms, norms)
+
+    item_similarity_scores = dish_similarity[selected_dish]
+    sorted_indices = np.argsort(item_similarity_scores)[::-1]
+    hood = sorted_indices[1:neighborhood_size+1]
+
+    rating_adjustment = 0.1 * (recommendation_rating - 3)
+    for i in hood:
+        current_rating = ratings[row, i]
+        if dish_similarity[selected_dish][i] < 0.5:
+            adjustment = 0.1
+        else:
+            adjustment = -0.2 if current_rating > 1.2 else 0
+        new_rating = round(np.clip(current_rating + rating_adjustment + adjustment, 1, 5), 1)
+        ratings[row, i] = observed[row, i] = new_rating
+
+
+@pytest.mark.parametrize('settings', [{}, SPARSE_SETTINGS], ids=['dense', 'sparse'])
+@pytest.mark.parametrize('signed_up', [False, True], ids=['rated', 'signed-up'])
+@pytest.mark.parametrize('synthetic', [False, True], ids=['survey', 'synthetic'])
+def test_apply_feedback_matches_baseline(load_engine, settings, signed_up, synthetic):
+    #? A rated recommendation list and the dish picked from it, the picked one also listed. On the survey every
+    #? neighbor is at least 0.5 similar, the synthetic ratings also take the baseline's other branch
+    dish_ids, rating = [0, 5, 9, 11, 3, 5], 4
+
+    engine = load_engine(synthetic=synthetic, **settings)
+    user_id = 900001 if signed_up else engine.user_index[10]
+    if signed_up:
+        engine.add_user(user_id, 'new')  #? No ratings: every dish reads the cold-start prior
+    row = engine.user_index.get_loc(user_id)
+    observed = engine.observed_matrix().toarray()
+    ratings = observed.copy()
+    ratings[row] = before = engine.rating_row(user_id)
+    for dish_id in dish_ids:
+        baseline_update_data(observed, ratings, row, dish_id, rating)
+
+    engine.apply_feedback(user_id, dish_ids, rating)
+    assert not np.array_equal(ratings[row], before)
+    np.testing.assert_array_equal(engine.rating_row(user_id), ratings[row])
+    np.testing.assert_array_equal(engine.observed_matrix().toarray(), observed)
+    assert engine.recent_selections(user_id) == dish_ids[-engine.RECENT_HISTORY:]
+
+
+#! Function to run the baseline get_recommendations up to its ingredient filter: the dishes rated below 3 as a list,
+#! sorted by rating, the recent ones skipped and the rest checked one by one against the ingredient set of the dish's
+#! inventory row (dish_ingredients, keyed by dish id)
+def baseline_recommendations(dish_ingredients, user_ratings, recent, available_ingredients, num_recommendations):
+    unrated_dishes = [(i, user_ratings[i]) for i in range(len(user_ratings)) if user_ratings[i] < 3]
+    sorted_unrated = sorted(unrated_dishes, key=lambda x: x[1], reverse=True)
+    recommendations = [(i, score) for i, score in sorted_unrated if i not in recent]
+
+    filtered_recommendations = []
+    for i, score in recommendations:
+        if i in dish_ingredients and dish_ingredients[i].issubset(set(available_ingredients)):
+            filtered_recommendations.append((i, score))
+    return filtered_recommendations[:num_recommendations]
+
+
+def test_ranked_path_matches_baseline(load_engine):
+    engine = load_engine()
+    inventory = pd.read_csv(engine.INVENTORY_PATH).rename(columns=engine.normalize_column)
+    dish_ingredients = {item_id - 1: set(row_ingredients(engine, row)) for item_id, (_, row)
+                        in zip(inventory['Item_id'], inventory.iterrows())}
+    rng = np.random.default_rng(3)
+    for row, user_id in enumerate(engine.user_index[:3]):
+        for dish_id in rng.choice(len(engine.dish_names), row, replace=False):
+            engine.remember_selection(user_id, int(dish_id))
+
+    #? Survey ratings are in tenths, so most lists hold tied scores; the baseline's stable sort keeps lower ids first
+    ranked = ties = 0
+    pantries = [list(engine.ingredient_columns)] + [
+        [name for name in engine.ingredient_columns if rng.random() < 0.7] for _ in range(4)]
+    for user_id in engine.user_index:
+        user_ratings = engine.rating_row(user_id)
+        recent = engine.recent_selections(user_id)
+        for pantry in pantries:
+            for num_recommendations in (1, 5, len(engine.dish_names)):
+                expected = baseline_recommendations(dish_ingredients, user_ratings, recent, pantry, num_recommendations)
+                path, recommendations = engine.recommend(user_id, pantry, None, num_recommendations)
+                if not expected:
+                    assert path != 'ranked'
+                    continue
+                assert path == 'ranked'
+                assert [(i, score) for i, score in recommendations] == expected
+                ranked += 1
+                scores = [score for _, score in expected]
+                ties += len(set(scores)) < len(scores)
+    assert ranked and ties
+
+
+#! Function to list the ingredients of an inventory row
+def row_ingredients(engine, row):
+    return [ingredient for ingredient in engine.ingredient_columns if row[ingredient] == 1]
+
+
+#! Function to check every dish of an inventory against its own row: listed, cookable from exactly its ingredients,
+#! served at its meal times and with its ingredients and meal times in the content features
+def assert_dishes_match(engine, inventory):
+    for dish_id, (_, row) in zip(inventory['Item_id'] - 1, inventory.iterrows()):
+        ingredients = row_ingredients(engine, row)
+        assert engine.dish_in_inventory[dish_id]
+        assert engine.check_ingredients(dish_id, ingredients)
+        assert not engine.check_ingredients(dish_id, ingredients[1:])
+        for meal_time in engine.meal_time_columns:
+            assert engine.meal_time_masks[meal_time][dish_id] == (row[meal_time] == 1)
+        content = engine.content_ingredients[dish_id].toarray().ravel()
+        assert [engine.ingredient_columns[j] for j in np.flatnonzero(content)] == ingredients
+        assert (engine.content_attributes[dish_id, :len(engine.meal_time_columns)] > 0).tolist() == \
+            (row[engine.meal_time_columns] == 1).tolist()
+
+
+def test_dishes_match_their_inventory_rows(load_engine):
+    engine = load_engine()
+    inventory = pd.read_csv(engine.INVENTORY_PATH).rename(columns=engine.normalize_column)
+    assert engine.dish_names[0] == 'Patta Gobi' and engine.dish_names[15] == 'Paneer Paratha'
+    assert (inventory['Item_id'] - 1).tolist() == list(range(len(engine.dish_names)))
+    assert_dishes_match(engine, inventory)
+
+
+def test_merged_inventory_adds_rating_columns(load_engine):
+    engine = load_engine()
+    similarity_array(engine)
+    inventory = pd.read_csv(os.path.join(REPO, "Dish_Inventory.csv")).rename(columns=engine.normalize_column)
+    with engine.state_writer():
+        added = engine.merge_inventory(inventory)
+
+    #? Item_ids 1 to 16 are the survey's columns, the rest are new dishes named after their rows
+    num_dishes = inventory['Item_id'].max()
+    assert added == num_dishes - 16
+    assert engine.stored_ratings.shape[1] == len(engine.dish_names) == num_dishes
+    new = inventory[inventory['Item_id'] > 16].drop_duplicates('Items')
+    assert engine.dish_names[new['Item_id'] - 1].tolist() == new['Items'].tolist()
+    assert_dishes_match(engine, inventory)
+
+    #? The new dishes can be rated and read their content neighbors at once
+    engine.update_data(engine.user_index[0], num_dishes - 1, 5)
+    assert similarity_array(engine).shape == (num_dishes, num_dishes)
+
+
+#! Function to pick the users with at least n dishes rated below 3, who get n ranked dishes from a full pantry
+def ranked_users(engine, n=3):
+    return [user_id for user_id in engine.user_index if (engine.rating_row(user_id) < 3).sum() >= n]
+
+
+#! Function to tell whether the next recommend() with these arguments is answered from the cache
+def cache_hit(engine, user_id, pantry, num_recommendations=5):
+    hits = engine.recommendation_cache_stats['hits']
+    engine.recommend(user_id, pantry, None, num_recommendations)
+    return engine.recommendation_cache_stats['hits'] == hits + 1
+
+
+@pytest.mark.parametrize('settings', [{}, SPARSE_SETTINGS], ids=['dense', 'sparse'])
+def test_cache_invalidated_by_feedback(load_engine, settings):
+    engine = load_engine(**settings)
+    similarity_array(engine)
+    user_id, other = ranked_users(engine)[:2]
+    pantry = list(engine.ingredient_columns)
+    engine.recommend(user_id, pantry)
+    engine.recommend(other, pantry)
+    assert cache_hit(engine, user_id, pantry)
+
+    invalidated = engine.recommendation_cache_stats['invalidated']
+    engine.update_data(user_id, 3, 5)
+    assert not cache_hit(engine, user_id, pantry)
+    assert engine.recommendation_cache_stats['invalidated'] == invalidated + 1
+    assert cache_hit(engine, user_id, pantry)
+
+    #? Selections are remembered too: a recent dish is no longer offered
+    dish_id = engine.recommend(user_id, pantry)[1][0][0]
+    engine.update_data(user_id, dish_id, 3)
+    path, recommendations = engine.recommend(user_id, pantry)
+    assert dish_id not in [i for i, _ in recommendations]
+
+    #? Another user's feedback leaves the entry alone
+    engine.update_data(other, 3, 5)
+    assert cache_hit(engine, user_id, pantry)
+
+
+def test_cache_invalidated_by_prior_change(load_engine):
+    engine = load_engine()
+    similarity_array(engine)
+    pantry = list(engine.ingredient_columns)
+
+    #? A signed-up user who rated four dishes low, so the rest read as the mean prior, next to a survey user who
+    #? rated every dish
+    engine.add_user(900001, 'new')
+    low = pd.DataFrame(1.0, index=pd.Index([900001], name='UserID'), columns=engine.dish_names[:4])
+    engine.merge_ratings(low)
+    rated = ranked_users(engine)[0]
+    assert not engine.fully_rated(900001) and engine.fully_rated(rated)
+    assert engine.recommend(900001, pantry)[0] == 'ranked' and cache_hit(engine, 900001, pantry)
+    assert engine.recommend(rated, pantry)[0] == 'ranked'
+
+    #? New users who rate the other dishes 5 move their priors, and only that; the signed-up user's own version stays
+    prior = engine.rating_row(900001)
+    version = engine.user_versions.get(900001)
+    batch = pd.DataFrame(5.0, index=pd.Index(range(900100, 900140), name='UserID'), columns=engine.dish_names[4:])
+    engine.merge_ratings(batch)
+    assert (engine.rating_row(900001)[4:] != prior[4:]).any()
+    assert engine.user_versions.get(900001) == version
+
+    assert not cache_hit(engine, 900001, pantry)
+    assert cache_hit(engine, rated, pantry)
+
+
+@pytest.mark.parametrize('settings', [{}, SPARSE_SETTINGS], ids=['dense', 'sparse'])
+def test_cache_invalidated_by_neighbor_change(load_engine, settings):
+    engine = load_engine(**settings)
+    similarity_array(engine)
+
+    #? With the ingredients of one dish in the pantry, a user none of whose candidates is close enough is answered by
+    #? the retry, which reads the candidates' neighbors
+    inventory = pd.read_csv(engine.INVENTORY_PATH).rename(columns=engine.normalize_column)
+    pantry = row_ingredients(engine, inventory[inventory['Item_id'] == 11].iloc[0])
+    for user_id in engine.user_index:
+        path, recommendations = engine.recommend(user_id, pantry)
+        if path == 'retry' and recommendations:
+            break
+    assert path == 'retry' and recommendations
+    assert cache_hit(engine, user_id, pantry)
+    candidates = np.flatnonzero(engine.rating_row(user_id) < 3)
+    versions = engine.neighbor_versions[candidates].copy()
+
+    #? Another user's ratings move the candidates' neighbor rows; the retry user's own ratings and prior stay
+    version = engine.rating_version(user_id)
+    other = engine.user_index[-1]
+    batch = pd.DataFrame(np.nan, index=pd.Index([other], name='UserID'), columns=engine.dish_names)
+    batch.iloc[0, candidates] = np.where(engine.rating_row(other)[candidates] > 3, 1.0, 5.0)
+    engine.merge_ratings(batch)
+    engine.current_similarity()
+    assert (engine.neighbor_versions[candidates] != versions).any()
+    assert engine.rating_version(user_id) == version
+
+    assert not cache_hit(engine, user_id, pantry)
+    assert cache_hit(engine, user_id, pantry)